@@ -197,6 +197,7 @@ class DFU:
     self.dnload_len = 0
     self.dnload_buf = bytearray(wTransferSize)
     self.open = 0
+    self.reader = None # flash read continues at self.reader.addr
 
   def handle_rx(self, cmd, arg, buf):
     # Handle an incoming packet of data.
@@ -269,6 +270,7 @@ class DFU:
         if self.addr < 0xF000000:
           ecp5.prog_close()
         else:
+          self.read_close()
           ecp5.flash_close()
         self.open = 0
     elif self.state == DFU.STATE_BUSY:
@@ -319,10 +321,20 @@ class DFU:
     return 0  # indicate success
 
   # read block from addr of flash memory.
+  # sequential blocks continue previous READ command
   def do_read(self, addr, buf):
-    ecp5.flash_read_block(buf, addr & 0xFFFFFF);
+    addr &= 0xFFFFFF
+    if self.reader is None or self.reader.addr != addr:
+      self.read_close()
+      self.reader = ecp5.flash_reader(addr)
+    self.reader.readinto(buf)
     return 0  # indicate success
 
+  def read_close(self):
+    if self.reader:
+      self.reader.close()
+      self.reader = None
+
   # if addr < 0xF000000, write block directly to FPGA RAM
   # blocks should come sequentially for FPGA RAM
   # of addr >= 0xF000000 write block to (addr & 0xFFF000) of flash memory.
@@ -331,6 +343,7 @@ class DFU:
       # write to FPGA RAM bitstream
       ecp5.hwspi.write(buf[:size])
     else: # addr >= 0xF000000 write to FLASH
+      self.read_close()
       ecp5.flash_write_block_retry(buf, addr & 0xFFF000)
     return 0  # indicate success
 
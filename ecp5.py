@@ -7,7 +7,7 @@
 from time import ticks_ms, sleep_ms
 from machine import SPI, SoftSPI, Pin, freq
 from micropython import const
-from struct import unpack
+from struct import unpack, pack_into
 from uctypes import addressof
 from gc import collect
 import jtagpin
@@ -19,6 +19,16 @@ flash_write_size = const(256)
 flash_erase_size = const(4096)
 flash_erase_cmd = { 4096:0x20, 32768:0x52, 65536:0xD8, 262144:0xD8 } # erase commands from FLASH PDF
 flash_era = bytearray([flash_erase_cmd[flash_erase_size],0,0])
+# lookahead for coalescing 4K erases into 32K/64K,
+# halved down to flash_erase_size if RAM is short
+flash_window = 65536
+# shadow index: crc32 of each sector, saved on VFS,
+# flash_stream skips read-back of sectors with same crc.
+# other flash writers (DFU, PTP, ecp5wp) remove the index.
+# directory is flashidx.index_dir
+flash_index = 0 # 1: enable
+flash_index_check = 16 # spot-check 1 of N skipped sectors, 0: never
+flash_index_sect = None # crc32 per sector while flash_stream runs
 flash_req=bytearray(4)
 read_status=bytearray([5])
 status=bytearray(1)
@@ -26,6 +36,9 @@ status=bytearray(1)
 #init_reverse_bits()
 # flashing
 flash_block=bytearray(flash_read_size)
+# 1: flash write, erase and status polling through hardware SPI
+# 0: through SoftSPI bitbanging (slow but glitch-free)
+flash_hwspi = getattr(jtagpin, "flash_hwspi", 1)
 
 def bitbang_jtag_on():
   global tck,tms,tdi,tdo,led
@@ -327,10 +340,17 @@ def prog_close():
 # FPGA will enter flashing mode
 # TAP should be in "select DR scan" state
 def flash_open():
-  global count_total,count_erase,count_write
+  global count_total,count_erase,count_write,count_write_bytes,count_write_ms,count_erase_cmd
+  global count_index_skip,count_index_check,flash_index_removed
   count_total = 0
   count_erase = 0
+  count_erase_cmd = { 4096:0, 32768:0, 65536:0 }
+  count_index_skip = 0
+  count_index_check = 0
+  flash_index_removed = 0
   count_write = 0
+  count_write_bytes = 0
+  count_write_ms = 0
   common_open()
   send_tms(1,6) # -> Test Logic Reset
   runtest_idle(1,0)
@@ -344,19 +364,38 @@ def flash_open():
   # \x1B -> 0xD8
   # \x60 -> 0x06 ...
 
+# TAP should be in "capture DR" state
+# hardware SPI 1 TCK-glitch moves TAP to "shift DR" state
+def hwspi_shift_begin():
+  hwspi.init(sck=Pin(jtagpin.tck)) # 1 TCK-glitch -> shift DR
+
+# switch from hardware SPI back to bitbanging
+# TAP remains in "shift DR" state
+def hwspi_shift_end():
+  hwspi.init(sck=Pin(jtagpin.tcknc)) # avoid TCK-glitch
+  bitbang_jtag_on()
+
 @micropython.viper
 def flash_wait_status(n:int):
   retry=n
   mask=1 # WIP bit (work-in-progress)
-  send_tms(0,2) # -> capture DR -> shift DR
-  swspi.write(read_status) # READ STATUS REGISTER
-  swspi.readinto(status)
+  if flash_hwspi:
+    send_tms(0,1) # -> capture DR
+    hwspi_shift_begin() # -> shift DR
+    spi=hwspi
+  else:
+    send_tms(0,2) # -> capture DR -> shift DR
+    spi=swspi
+  spi.write(read_status) # READ STATUS REGISTER
+  spi.readinto(status)
   while retry > 0:
-    swspi.readinto(status)
+    spi.readinto(status)
     if (int(status[0]) & mask) == 0:
       break
     sleep_ms(1)
     retry -= 1
+  if flash_hwspi:
+    hwspi_shift_end()
   send_tms(1,1) # -> exit 1 DR # exit at byte incomplete
   #send_int_msb1st(0,1,8) # exit at byte complete
   send_tms0111() # -> select DR scan
@@ -370,8 +409,14 @@ def flash_erase_block(addr:int):
   p8=ptr8(addressof(flash_era))
   p8[1]=addr>>16
   p8[2]=addr>>8
-  send_tms(0,2) # -> capture DR -> shift DR
-  swspi.write(flash_era) # except LSB
+  if flash_hwspi:
+    send_tms(0,1) # -> capture DR
+    hwspi_shift_begin() # -> shift DR
+    hwspi.write(flash_era) # except LSB
+    hwspi_shift_end()
+  else:
+    send_tms(0,2) # -> capture DR -> shift DR
+    swspi.write(flash_era) # except LSB
   send_int_msb1st(addr,1,8) # last LSB byte -> exit 1 DR
   send_tms0111() # -> select DR scan
   flash_wait_status(2002)
@@ -385,9 +430,16 @@ def flash_write_block(block, last:int, addr:int):
   p8[1]=addr>>16
   p8[2]=addr>>8
   p8[3]=addr
-  send_tms(0,2) # -> capture DR -> shift DR
-  swspi.write(flash_req)
-  swspi.write(block) # whole block
+  if flash_hwspi:
+    send_tms(0,1) # -> capture DR
+    hwspi_shift_begin() # -> shift DR
+    hwspi.write(flash_req)
+    hwspi.write(block) # whole block
+    hwspi_shift_end()
+  else:
+    send_tms(0,2) # -> capture DR -> shift DR
+    swspi.write(flash_req)
+    swspi.write(block) # whole block
   send_int_msb1st(last,1,8) # last byte -> exit 1 DR
   send_tms0111() # -> select DR scan
   flash_wait_status(1004)
@@ -401,20 +453,213 @@ def flash_read_block(data, addr:int):
   p8[2]=addr>>8
   p8[3]=addr
   send_tms(0,1) # -> capture DR
-  hwspi.init(sck=Pin(jtagpin.tck)) # 1 TCK-glitch -> shift DR
+  hwspi_shift_begin() # -> shift DR
   hwspi.write(flash_req) # send SPI FLASH read command and address and dummy byte
   hwspi.readinto(data) # retrieve whole block
-  hwspi.init(sck=Pin(jtagpin.tcknc)) # avoid TCK-glitch
-  bitbang_jtag_on()
+  hwspi_shift_end()
   send_int_msb1st(0,1,8) # dummy read byte -> exit 1 DR
   send_tms0111() # -> select DR scan
 
+# continuous flash read: one READ command, then TAP stays
+# in "shift DR" and each readinto() clocks more data.
+# length=-1: unlimited (wraps at end of FLASH)
+# no other JTAG access until close()
+# before: ecp5.flash_open()
+# after:  close(), ecp5.flash_close()
+class flash_reader:
+  def __init__(self, addr=0, length=-1):
+    self.addr = addr
+    self.remain = length
+    flash_req[0] = 3
+    flash_req[1] = addr>>16&0xFF
+    flash_req[2] = addr>>8&0xFF
+    flash_req[3] = addr&0xFF
+    send_tms(0,1) # -> capture DR
+    hwspi_shift_begin() # -> shift DR
+    hwspi.write(flash_req) # send SPI FLASH read command and address
+    self.active = 1
+
+  def readinto(self, buf):
+    n = len(buf)
+    if self.remain >= 0 and n > self.remain:
+      n = self.remain
+      buf = memoryview(buf)[:n]
+    if n <= 0 or not self.active:
+      return 0
+    hwspi.readinto(buf)
+    self.addr += n
+    if self.remain > 0:
+      self.remain -= n
+    return n
+
+  def close(self):
+    if self.active:
+      hwspi_shift_end()
+      send_int_msb1st(0,1,8) # dummy read byte -> exit 1 DR
+      send_tms0111() # -> select DR scan
+      self.active = 0
+
+# read flash to sink: object with write() (file, socket)
+# or update() (hash), reusing one buffer of blocksize
+# before: ecp5.flash_open()
+# after:  ecp5.flash_close()
+def flash_read_stream(sink, addr=0, length=0, blocksize=4096):
+  if hasattr(sink, "update"):
+    out = sink.update
+  else:
+    out = sink.write
+  block = bytearray(min(blocksize,length))
+  mv = memoryview(block)
+  reader = flash_reader(addr, length)
+  while True:
+    n = reader.readinto(block)
+    if n == 0:
+      break
+    out(mv[:n])
+  reader.close()
+  return length
+
+# hash of flash range, returns hex string
+# algo: "crc32" or hashlib name "sha256", "sha1", "md5"
+def flash_hash(addr=0, length=0x1000000, algo="sha256"):
+  from binascii import hexlify
+  from hashsum import hash_new
+  collect()
+  h = hash_new(algo)
+  flash_open()
+  stopwatch_start()
+  flash_read_stream(h, addr, length)
+  stopwatch_stop(length)
+  flash_close()
+  return hexlify(h.digest()).decode()
+
+# FLASH size in bytes from JEDEC ID
+# before: ecp5.flash_open()
+def flash_chip_size():
+  jedec=bytearray(3)
+  flash_read_id(0x9F,jedec)
+  return flash_capacity(jedec[2])
+
+# JEDEC ID capacity byte 2^n bytes, 64K..64M
+# 0 if no FLASH responds (0xFF) or unknown code
+def flash_capacity(n:int)->int:
+  if 16<=n<=26:
+    return 1<<n
+  return 0
+
+# cmd 0x9F: JEDEC ID, data=bytearray(3)
+def flash_read_id(cmd, data):
+  send_tms(0,1) # -> capture DR
+  hwspi_shift_begin() # -> shift DR
+  hwspi.write(bytearray([cmd]))
+  hwspi.readinto(data)
+  hwspi_shift_end()
+  send_int_msb1st(0,1,8) # dummy read byte -> exit 1 DR
+  send_tms0111() # -> select DR scan
+
+# size: 4096, 32768 or 65536
+def flash_erase(addr, size):
+  global count_erase,count_write_ms
+  t0=ticks_ms()
+  flash_era[0]=flash_erase_cmd[size]
+  flash_erase_block(addr)
+  flash_era[0]=flash_erase_cmd[flash_erase_size]
+  flash_wait_status(2005) # 64K erase takes longer
+  count_erase+=size//flash_erase_size
+  count_erase_cmd[size]+=1
+  count_write_ms+=ticks_ms()-t0
+
+# read-compare file_block with flash at addr,
+# aligned runs of sectors which all must be erased
+# are erased with one 32K/64K command, other
+# sectors are left for flash_write_block_retry.
+# known: sectors marked 1 are known to be equal, not read
+# returns list of compare results per sector for
+# flash_write_block_retry: None not read (known),
+# -1 must erase, else bitmap of pages to write (0: equal).
+# erased sectors get bitmap of all non-0xFF pages
+def flash_erase_coalesce(file_block, addr, known=None):
+  nsec=len(file_block)//flash_erase_size
+  cmp=[None]*nsec
+  file_blockmv=memoryview(file_block)
+  for i in range(nsec):
+    if known and known[i]==1:
+      continue
+    pages=0
+    for j in range(0,flash_erase_size,flash_read_size):
+      a=i*flash_erase_size+j
+      flash_read_block(flash_block,addr+a)
+      p=compare_flash_file_pages(flash_block,file_blockmv[a:a+flash_read_size])
+      if p<0:
+        pages=-1
+        break
+      pages|=p<<(j>>8)
+    cmp[i]=pages
+  erase=bytearray(1 if c==-1 else 0 for c in cmp)
+  i=0
+  while i<nsec:
+    for size in (65536,32768):
+      n=size//flash_erase_size
+      if (addr+i*flash_erase_size)&(size-1)==0 and i+n<=nsec and sum(erase[i:i+n])==n:
+        flash_erase(addr+i*flash_erase_size,size)
+        erase_done(cmp,file_blockmv,i,i+n)
+        i+=n
+        break
+    else:
+      i+=1
+  return cmp
+
+# sectors a..b-1 are erased, write all non-0xFF pages
+def erase_done(cmp,file_blockmv,a,b):
+  for i in range(a,b):
+    cmp[i]=file_pages(file_blockmv[i*flash_erase_size:(i+1)*flash_erase_size])
+
+def flash_index_name():
+  from binascii import hexlify
+  id=bytearray(15)
+  flash_read_id(0x9F,memoryview(id)[0:3]) # JEDEC ID
+  flash_read_id(0x4B,memoryview(id)[3:15]) # 4 dummy + unique ID
+  id[3:7]=b""
+  import flashidx
+  return flashidx.name(hexlify(id).decode()), flash_capacity(id[2])
+
+def flash_index_load():
+  global flash_index_sect,flash_index_file
+  flash_index_file,size=flash_index_name()
+  if size==0: # JEDEC ID not valid, run without index
+    print("FLASH size unknown, index not used")
+    flash_index_sect=None
+    return
+  flash_index_sect=bytearray(size//flash_erase_size*4)
+  try:
+    with open(flash_index_file,"rb") as f:
+      f.readinto(flash_index_sect)
+  except OSError:
+    pass
+
+def flash_index_save():
+  global flash_index_sect
+  try:
+    with open(flash_index_file,"wb") as f:
+      f.write(flash_index_sect)
+  except OSError:
+    print("can't save %s" % flash_index_file)
+  flash_index_sect=None
+
+def flash_index_remove():
+  global flash_index_removed
+  import flashidx
+  flashidx.remove()
+  flash_index_removed=1
+
 # writes file_block to flash
 # len(file_block) == flash_erase_size
+# cmp: compare result from flash_erase_coalesce,
+# saves first read-back, None: read flash
 # before: ecp5.flash_open()
 # after:  ecp5.flash_close()
-def flash_write_block_retry(file_block,addr:int):
-  global count_total,count_erase,count_write
+def flash_write_block_retry(file_block,addr:int,cmp=None):
+  global count_total,count_erase,count_write,count_write_bytes,count_write_ms
   if len(file_block)!=flash_erase_size:
     return False
   file_blockmv=memoryview(file_block)
@@ -423,35 +668,50 @@ def flash_write_block_retry(file_block,addr:int):
     # print("addr must be rounded to flash_erase_size = %d bytes (& 0x%06X)" % (flash_erase_size, 0xFFFFFF & ~addr_mask))
     return False
   addr=addr&0xFFFFFF&~addr_mask # rounded to even erase size
-  bytes_uploaded=0
   retry=3
   while retry>0:
-    must=0
-    flash_rd=0
-    while flash_rd<flash_erase_size:
-      flash_read_block(flash_block,addr+flash_rd)
-      must=compare_flash_file_buf(flash_block,file_blockmv[flash_rd:flash_rd+flash_read_size],must)
-      flash_rd+=flash_read_size
-    write_addr=addr
-    if must==0:
-      addr+=len(file_block)
+    must_erase=0
+    pages=0 # bitmap of pages to write
+    if cmp is None:
+      flash_rd=0
+      while flash_rd<flash_erase_size:
+        flash_read_block(flash_block,addr+flash_rd)
+        p=compare_flash_file_pages(flash_block,file_blockmv[flash_rd:flash_rd+flash_read_size])
+        if p<0:
+          must_erase=1
+          break # no need to read the rest
+        pages|=p<<(flash_rd>>8)
+        flash_rd+=flash_read_size
+    elif cmp<0:
+      must_erase=1
+    else:
+      pages=cmp
+    cmp=None # verify by reading
+    if must_erase==0 and pages==0:
       count_total+=1
       break
     retry-=1
-    if must&1: # must_erase:
-      #print("from 0x%06X erase %dK" % (write_addr, flash_erase_size>>10),end="\r")
-      flash_erase_block(write_addr)
+    if flash_index_sect is None and not flash_index_removed:
+      flash_index_remove() # written by other path
+    t0=ticks_ms()
+    if must_erase:
+      #print("from 0x%06X erase %dK" % (addr, flash_erase_size>>10),end="\r")
+      flash_erase_block(addr)
       count_erase+=1
-    if must&2: # must_write:
-      #print("from 0x%06X write %dK" % (write_addr, flash_erase_size>>10),end="\r")
+      count_erase_cmd[flash_erase_size]+=1
+      pages=file_pages(file_block) # after erase write all non-0xFF pages
+    if pages:
+      #print("from 0x%06X write %dK" % (addr, flash_erase_size>>10),end="\r")
       block_addr=0
-      next_block_addr=0
-      while next_block_addr<len(file_block):
-        next_block_addr=block_addr+flash_write_size
-        flash_write_block(file_blockmv[block_addr:next_block_addr-1],file_blockmv[next_block_addr-1],write_addr)
-        write_addr+=flash_write_size
-        block_addr=next_block_addr
+      while pages:
+        if pages&1:
+          next_block_addr=block_addr+flash_write_size
+          flash_write_block(file_blockmv[block_addr:next_block_addr-1],file_blockmv[next_block_addr-1],addr+block_addr)
+          count_write_bytes+=flash_write_size
+        pages>>=1
+        block_addr+=flash_write_size
       count_write+=1
+    count_write_ms+=ticks_ms()-t0
   if retry<=0:
     return False
   return True
@@ -479,23 +739,146 @@ def stopwatch_start():
 def stopwatch_stop(bytes_uploaded):
   global stopwatch_ms
   elapsed_ms=ticks_ms()-stopwatch_ms
-  transfer_rate_MBps=0
+  transfer_rate_kBps=0
   if elapsed_ms>0:
     transfer_rate_kBps=bytes_uploaded//elapsed_ms
   print("%d bytes uploaded in %d ms (%d kB/s)" % (bytes_uploaded,elapsed_ms,transfer_rate_kBps))
 
+# read into buf, return number of bytes read
+# fill: repeat reading until buf is full,
+# pad last block with 0xFF up to multiple of fill
+def stream_fill(dstream, buf, fill):
+  n = dstream.readinto(buf) or 0
+  if fill and n:
+    mv = memoryview(buf)
+    while n < len(buf):
+      r = dstream.readinto(mv[n:])
+      if not r:
+        end = (n+fill-1)//fill*fill
+        mv[n:end] = b"\xFF" * (end-n)
+        return end
+      n += r
+  return n
+
+# pipelined streaming: _thread reader fills rotating
+# buffers while caller shifts out previous buffer
+# 0-1: lock-step, no thread
+pipeline_nbuf = 2
+pipeline_wait_rd = 0 # ms reader waited for free buffer
+pipeline_wait_wr = 0 # ms writer waited for data
+pipeline_stop_ms = 2000 # wait for reader to stop, then close dstream
+pipeline_stack = 12288 # bytes, reader may run deflate
+
+# ctl: [run, error] of this pipeline only,
+# reader left blocked in a read can't disturb the next one
+# run: 1 reading, 2 stop requested, 0 stopped
+def pipeline_reader(dstream, bufs, lens, fill, ctl, first):
+  global pipeline_wait_rd
+  i = 0
+  try:
+    while ctl[0] == 1:
+      if lens[i] >= 0: # all buffers full, wait for writer
+        t0 = ticks_ms()
+        while lens[i] >= 0 and ctl[0] == 1:
+          sleep_ms(1)
+        pipeline_wait_rd += ticks_ms()-t0
+        continue
+      n = stream_fill(dstream, memoryview(bufs[i])[:first] if first else bufs[i], fill)
+      first = 0
+      lens[i] = n
+      if n == 0:
+        break
+      i = (i+1) % len(bufs)
+  except Exception as e:
+    ctl[1] = e
+    lens[i] = 0
+  ctl[0] = 0
+
+# wait for reader to stop, False on timeout
+def pipeline_join(ctl):
+  t0 = ticks_ms()
+  while ctl[0]:
+    if ticks_ms()-t0 > pipeline_stop_ms:
+      return False
+    sleep_ms(1)
+  return True
+
+# generator of memoryview blocks read from dstream
+# first: length of first block, aligns the following ones
+def stream_blocks(dstream, blocksize=4096, fill=0, first=0):
+  global pipeline_wait_rd, pipeline_wait_wr
+  pipeline_wait_rd = 0
+  pipeline_wait_wr = 0
+  bufs = None
+  if pipeline_nbuf > 1:
+    try:
+      import _thread
+      bufs = [bytearray(blocksize) for i in range(pipeline_nbuf)]
+      lens = [-1] * len(bufs) # -1: free, 0: end, >0: bytes
+      ctl = [1, None]
+      try:
+        old = _thread.stack_size(pipeline_stack)
+      except ValueError: # size not accepted (CPython min 32K), default stack
+        old = None
+      try:
+        _thread.start_new_thread(pipeline_reader, (dstream, bufs, lens, fill, ctl, first))
+      finally:
+        if old is not None:
+          _thread.stack_size(old)
+    except (ImportError, MemoryError, OSError, RuntimeError):
+      bufs = None # no thread, fall back to lock-step
+  if bufs is None: # lock-step
+    block = bytearray(blocksize)
+    mv = memoryview(block)
+    while True:
+      n = stream_fill(dstream, mv[:first] if first else block, fill)
+      first = 0
+      if n == 0:
+        return
+      yield mv[:n]
+  i = 0
+  try:
+    while True:
+      if lens[i] < 0: # all buffers empty, wait for reader
+        t0 = ticks_ms()
+        while lens[i] < 0:
+          sleep_ms(1)
+        pipeline_wait_wr += ticks_ms()-t0
+      n = lens[i]
+      if n == 0:
+        break
+      yield memoryview(bufs[i])[:n]
+      lens[i] = -1
+      i = (i+1) % len(bufs)
+  finally:
+    if ctl[0]:
+      ctl[0] = 2 # stop reader
+      if not pipeline_join(ctl):
+        try:
+          dstream.close() # reader blocked in read, e.g. idle socket
+        except:
+          pass
+        pipeline_join(ctl)
+  if ctl[1]:
+    raise ctl[1]
+
+def pipeline_report():
+  if pipeline_nbuf > 1:
+    print("pipeline %d buffers: reader waited %d ms, writer waited %d ms" % (pipeline_nbuf,pipeline_wait_rd,pipeline_wait_wr))
+
 def prog_stream(dstream, blocksize=4096):
   prog_open()
   bytes_uploaded = 0
   stopwatch_start()
-  block = bytearray(blocksize)
-  while True:
-    if dstream.readinto(block):
+  blocks = stream_blocks(dstream, blocksize)
+  try:
+    for block in blocks:
       hwspi.write(block)
       bytes_uploaded += len(block)
-    else:
-      break
+  finally:
+    blocks.close() # stop reader thread
   stopwatch_stop(bytes_uploaded)
+  pipeline_report()
   prog_stream_done()
 
 def prog_stream_gz(dstream, blocksize=4096, name=""):
@@ -509,22 +892,10 @@ def prog_stream_gz(dstream, blocksize=4096, name=""):
   else:
     prog_stream(dstream, blocksize)
 
+# body stream from web or webget cache
 def open_web(url):
-  import socket
-  _, _, host, path = url.split('/', 3)
-  port = 80
-  if ( len(host.split(':')) == 2 ):
-    host, port = host.split(':', 2)
-    port = int(port)
-  print("host = %s, port = %d, path = %s" % (host, port, path))
-  addr = socket.getaddrinfo(host, port)[0][-1]
-  s = socket.socket()
-  s.connect(addr)
-  s.send(bytes('GET /%s HTTP/1.0\r\nHost: %s\r\nAccept:  image/*\r\n\r\n' % (path, host), 'utf8'))
-  for i in range(100): # read first 100 lines searching for
-    if len(s.readline()) < 3: # first empty line (contains "\r\n")
-      break
-  return s
+  import webget
+  return webget.get(url)
 
 # data is bytearray of to-be-read length
 def flash_read(data, addr=0):
@@ -532,35 +903,59 @@ def flash_read(data, addr=0):
   flash_read_block(data, addr)
   flash_close()
 
-# accelerated compare flash and file block
+# accelerated compare flash and file block in single pass
 # return value
-# 0-must nothing, 1-must erase, 2-must write, 3-must erase and write
+# -1: must erase (returns at first such byte)
+# else bitmap of 256-byte pages which must be written
 @micropython.viper
-def compare_flash_file_buf(flash_b, file_b, must:int)->int:
+def compare_flash_file_pages(flash_b, file_b)->int:
   flash_block = ptr8(addressof(flash_b))
   file_block = ptr8(addressof(file_b))
   l = int(len(file_b))
+  pages = 0
   for i in range(l):
-    if (flash_block[i] & file_block[i]) != file_block[i]:
-      must = 1
-  if must: # erase will reset all bytes to 0xFF
-    for i in range(l):
-      if file_block[i] != 0xFF:
-        must = 3
-  else: # no erase
-    for i in range(l):
-      if flash_block[i] != file_block[i]:
-        must = 2
-  return must
+    a = flash_block[i]
+    b = file_block[i]
+    if a != b:
+      if (a & b) != b:
+        return -1
+      pages |= 1 << (i >> 8)
+  return pages
+
+# bitmap of 256-byte pages which are not all 0xFF
+@micropython.viper
+def file_pages(file_b)->int:
+  file_block = ptr8(addressof(file_b))
+  l = int(len(file_b))
+  pages = 0
+  i = 0
+  while i < l:
+    if file_block[i] != 0xFF:
+      pages |= 1 << (i >> 8)
+      i = (i | 0xFF) + 1 # next page
+    else:
+      i += 1
+  return pages
 
 def flash_report():
-  print("%dK blocks: %d total, %d erased, %d written." % (flash_erase_size>>10,count_total,count_erase,count_write))
+  print("%dK blocks: %d total, %d erased, %d written, %d pages." % (flash_erase_size>>10,count_total,count_erase,count_write,count_write_bytes//flash_write_size))
+  if count_index_skip+count_index_check:
+    print("index: %d blocks not read back, %d spot-checked" % (count_index_skip,count_index_check))
+  c=count_erase_cmd
+  if c[4096]+c[32768]+c[65536]:
+    print("erase commands: 4K %d, 32K %d, 64K %d" % (c[4096],c[32768],c[65536]))
+  if count_write_ms>0:
+    print("erase+write %d bytes in %d ms (%d kB/s) %s SPI" % (count_write_bytes,count_write_ms,count_write_bytes//count_write_ms,"hard" if flash_hwspi else "soft"))
 
 # clever = read-compare-erase-write
 # prevents flash wear when overwriting the same data
-# 4K erase block is max that fits on ESP32-WROOM
+# reads flash_window ahead to coalesce erases,
+# smaller window if RAM is short (ESP32-WROOM)
+# windows after the first are aligned to window size,
+# so 32K/64K erases apply also from unaligned addr.
 # returns status True-OK False-Fail
 def flash_stream(dstream,addr=0):
+  global count_total,count_index_skip,count_index_check
   flash_open()
   addr_mask=flash_erase_size-1
   if addr&addr_mask:
@@ -568,34 +963,81 @@ def flash_stream(dstream,addr=0):
     return False
   addr=addr&0xFFFFFF&~addr_mask # rounded to even 64K (erase block)
   stopwatch_start()
-  #if 1:
-  #  print("erase whole FLASH (max 90s)")
-  #  sdr(b"\x60") # SPI WRITE ENABLE
-  #  flash_wait_status(1005)
-  #  sdr(b"\xE3") # BULK ERASE (whole chip) rb[0x60]=0x06 or rb[0xC7]=0xE3
-  #  flash_wait_status(90000)
-  file_block=bytearray(flash_erase_size)
-  start_addr=addr
-  while dstream.readinto(file_block):
-    led.value(addr>>12&1)
-    retval=flash_write_block_retry(file_block,addr)
-    if retval==False:
+  window=flash_window
+  while window>flash_erase_size:
+    try:
+      collect()
+      bytearray(window*max(1,pipeline_nbuf))
       break
-    addr+=len(file_block)
+    except MemoryError:
+      window>>=1
+  if flash_index:
+    from binascii import crc32
+    from random import getrandbits
+    flash_index_load()
+  nidx=len(flash_index_sect)>>2 if flash_index_sect else 0 # sectors of chip
+  start_addr=addr
+  retval=True
+  blocks=stream_blocks(dstream,window,flash_erase_size,window-(addr&(window-1)))
+  try:
+    for window_block in blocks:
+      nsec=len(window_block)//flash_erase_size
+      known=None
+      if flash_index_sect:
+        known=bytearray(nsec)
+        crc=[0]*nsec
+        for i in range(nsec):
+          crc[i]=crc32(window_block[i*flash_erase_size:(i+1)*flash_erase_size]) or 1
+          sect=(addr>>12)+i
+          if sect<nidx and crc[i]==unpack("<I",flash_index_sect[4*sect:4*sect+4])[0]:
+            if flash_index_check and getrandbits(16)%flash_index_check==0:
+              count_index_check+=1
+              known[i]=2 # spot-check, read back
+            else:
+              count_index_skip+=1
+              known[i]=1
+      cmp=None
+      if nsec>1:
+        cmp=flash_erase_coalesce(window_block,addr,known)
+      for i in range(nsec):
+        led.value(addr>>12&1)
+        if known and known[i]==1:
+          count_total+=1
+        elif cmp and cmp[i]==0:
+          count_total+=1
+        else:
+          written=count_erase+count_write
+          retval=flash_write_block_retry(window_block[i*flash_erase_size:(i+1)*flash_erase_size],addr,cmp[i] if cmp else None)
+          if retval==False:
+            break
+          if known and known[i]==2 and count_erase+count_write!=written:
+            print("index spot-check 0x%06X differs, index discarded" % addr)
+            flash_index_sect[:]=bytearray(len(flash_index_sect))
+            known=bytearray(nsec) # sectors not read have cmp None
+        if flash_index_sect and addr>>12<nidx: # not past chip end
+          pack_into("<I",flash_index_sect,4*(addr>>12),crc[i])
+        addr+=flash_erase_size
+      if retval==False:
+        break
+  finally:
+    blocks.close() # stop reader thread
+    if flash_index_sect:
+      flash_index_save()
   stopwatch_stop(addr-start_addr)
   flash_report()
+  pipeline_report()
   return retval # True if successful
 
 def flash_stream_gz(dstream, addr=0, name=""):
   if name.lower().endswith(".gz"):
     try:
       import deflate
-      flash_stream(deflate.DeflateIO(dstream), addr)
+      return flash_stream(deflate.DeflateIO(dstream), addr)
     except:
       import uzlib
-      flash_stream(uzlib.DecompIO(dstream,31), addr)
+      return flash_stream(uzlib.DecompIO(dstream,31), addr)
   else:
-    flash_stream(dstream, addr)
+    return flash_stream(dstream, addr)
 
 def datastream(filepath):
   if filepath.startswith("http://") or filepath.startswith("/http:/"):
@@ -607,7 +1049,10 @@ def prog(filepath, close=True):
   collect()
   dstream = datastream(filepath)
   if dstream:
-    prog_stream_gz(dstream,4096,filepath)
+    try:
+      prog_stream_gz(dstream,4096,filepath)
+    finally:
+      dstream.close() # web: keep-alive socket back to pool
     # NOTE now the SD card can be released before bitstream starts
     if close:
       return prog_close() # start the bitstream
@@ -618,18 +1063,35 @@ def flash(filepath, addr=0, close=True):
   collect()
   dstream = datastream(filepath)
   if dstream:
-    status=flash_stream_gz(dstream,addr,filepath)
+    try:
+      status=flash_stream_gz(dstream,addr,filepath)
+    finally:
+      dstream.close()
     # NOTE now the SD card can be released before bitstream starts
     if close:
       flash_close() # start the bitstream
     return status
   return False
 
-def flashrd(addr=0, length=1):
+# sink: None returns bytearray of length
+# else file name or object with write() or update()
+def flashrd(addr=0, length=1, sink=None):
   collect()
-  data = bytearray(length)
-  flash_read(data, addr)
-  return data
+  if sink is None:
+    data = bytearray(length)
+    flash_read(data, addr)
+    return data
+  f = None
+  if isinstance(sink, str):
+    sink = f = open(sink, "wb")
+  flash_open()
+  stopwatch_start()
+  flash_read_stream(sink, addr, length)
+  stopwatch_stop(length)
+  flash_close()
+  if f:
+    f.close()
+  return length
 
 def passthru():
   collect()
@@ -638,7 +1100,12 @@ def passthru():
     filepath = "passthru%08x.bit.gz" % id
     print("ecp5.prog(\"%s\")" % filepath)
     dstream = datastream(filepath)
-    prog_stream_gz(dstream,4096,filepath)
+    if not dstream:
+      return False
+    try:
+      prog_stream_gz(dstream,4096,filepath)
+    finally:
+      dstream.close()
     return prog_close()
   return False
 
@@ -646,6 +1113,8 @@ def help():
   print("usage:")
   print("ecp5.flash(\"blink.bit.gz\", addr=0x000000)")
   print("ecp5.flashrd(addr=0x000000, length=1)")
+  print("ecp5.flashrd(addr=0x000000, length=0x200000, sink=\"dump.bin\")")
+  print("ecp5.flash_hash(addr=0x000000, length=0x200000, algo=\"sha256\")")
   print("ecp5.prog(\"http://192.168.4.2/blink.bit\")")
   print("ecp5.prog(\"blink.bit.gz\") # gzip -9 blink.bit")
   print("ecp5.passthru()")
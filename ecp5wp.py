@@ -331,6 +331,13 @@ def flash_sendrecv(send,recv):
   send_int_msb1st(0,1,8) # complete dummy byte and exit
   send_tms0111() # -> select DR scan
 
+# status register writes change what ecp5.flash_stream
+# can write, so remove its flash shadow index
+# index of ecp5.flash_index in flashidx.index_dir
+def flash_index_remove():
+  import flashidx
+  flashidx.remove()
+
 def int2bin(a):
   bin=bytearray(8)
   for i in range(8):
@@ -343,6 +350,7 @@ def int2bin(a):
 # prot=0: unprotect
 # prot=6: protect first 2MB
 def is25lp128_protect(prot=6):
+  flash_index_remove()
   flash_open()
   # write function register
   # factory default is protecting the top (... - 0xFFFFFF)
@@ -398,6 +406,7 @@ def is25lp128_status():
 # prot= 0: unprotect  
 # prot=12: protecting first 2MB
 def w25q128jv_protect(prot=12):
+  flash_index_remove()
   flash_open()
   flash_wait_status(1021)
   flash_send(b"\x06") # permanent write
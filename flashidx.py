@@ -0,0 +1,24 @@
+# micropython ESP32
+# FLASH shadow index files of ecp5.flash_stream
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+# small on purpose: ecp5wp and others remove the index
+# without importing JTAG driver ecp5.py
+
+index_dir = "/" # directory of flash_<jedec><unique id>.idx
+
+def name(id_hex):
+  return index_dir+"flash_"+id_hex+".idx"
+
+# remove index of any FLASH chip,
+# after FLASH is written by other path
+def remove():
+  from os import listdir,remove
+  try:
+    for f in listdir(index_dir):
+      if f.startswith("flash_") and f.endswith(".idx"):
+        remove(index_dir+f)
+  except OSError:
+    pass
@@ -0,0 +1,27 @@
+# micropython ESP32
+# hash objects for ecp5, sdraw, uftpd and ptp
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+# small on purpose: hashing SD card or files
+# doesn't import JTAG driver ecp5.py
+
+# crc32 with hashlib-like update() and digest()
+class crc32sum:
+  def __init__(self):
+    self.crc = 0
+
+  def update(self, data):
+    from binascii import crc32
+    self.crc = crc32(data, self.crc)
+
+  def digest(self):
+    return self.crc.to_bytes(4, "big")
+
+# algo: "crc32" or hashlib name "sha256", "sha1", "md5"
+def hash_new(algo="sha256"):
+  if algo == "crc32":
+    return crc32sum()
+  import hashlib
+  return getattr(hashlib, algo)()
@@ -7,7 +7,10 @@ $MPREMOTE connect $PORT mkdir :/lib
 $MPREMOTE connect $PORT cp ecp5.py :/lib/ecp5.py
 $MPREMOTE connect $PORT cp uftpd.py :/lib/uftpd.py
 $MPREMOTE connect $PORT cp sdraw.py :/lib/sdraw.py
+$MPREMOTE connect $PORT cp webget.py :/lib/webget.py
 $MPREMOTE connect $PORT cp ecp5wp.py :/lib/ecp5wp.py
+$MPREMOTE connect $PORT cp flashidx.py :/lib/flashidx.py
+$MPREMOTE connect $PORT cp hashsum.py :/lib/hashsum.py
 $MPREMOTE connect $PORT cp ecp5setup.py :/lib/ecp5setup.py
 $MPREMOTE connect $PORT cp dfu.py :/lib/dfu.py
 $MPREMOTE connect $PORT cp ptp.py :/lib/ptp.py
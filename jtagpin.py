@@ -29,3 +29,8 @@ led = const(5)
 #tdo = const(7) # 37
 #tcknc = const(12) # free pin for SPI workaround
 #led = const(13)
+
+# SPI FLASH write, erase and status polling
+# 1: hardware SPI (fast)
+# 0: SoftSPI bitbanging (slow, for pinouts where hardware SPI glitches)
+flash_hwspi = const(1)
@@ -34,10 +34,11 @@ PROTOCOL=b"MTP" # libmtp, windows and apple, linux write but not read
 #
 # The device will then change to the custom USB device.
 
-import machine,struct,time,os,uctypes,re
+import machine,struct,time,os,uctypes,re,micropython
+from array import array
 from micropython import const
 #import hashlib
-import ecp5
+import ecp5,hashsum
 
 VID = const(0x1234)
 PID = const(0xabcd)
@@ -234,6 +235,8 @@ CNT_HDR_DESC = {
 "h2"  :16 | uctypes.UINT16,
 "p2"  :16 | uctypes.UINT32,
 "p3"  :20 | uctypes.UINT32,
+"p4"  :24 | uctypes.UINT32,
+"p5"  :28 | uctypes.UINT32,
 }
 
 # some USB CTRL commands (FIXME)
@@ -247,19 +250,24 @@ txid=0
 
 # global sendobject (receive file) length
 send_parent=0 # to which directory we will send object
-send_parent_path="/"
 send_length=0
 remaining_send_length=0
 remain_getobj_len=0
 addr=0
 fd=None # local open file descriptor
 
-# for ls() generating vfs directory tree
-# global handle incremented
-# next handle must start for 0 to assign
-# root with 0. if next_handle!=0 vfs will
-# appear as empty
-next_handle=0
+# SendObject to flash: USB OUT data of any length is
+# appended to ring, whole 4096-byte blocks are flashed
+# in place from ring offset 0 or 4096. allocated
+# only while sending to flash
+flash_ring=None
+ring_rd=0 # bytes flashed
+ring_wr=0 # bytes received
+ring_ok=True # False after a block failed, latched until next SendObject
+
+# objects sent to custom fs get handles with
+# next_handle in low bits
+next_handle=1
 current_send_handle=0
 
 readme_txt=b"PTP/MTP FPGA programmer\n\
@@ -270,18 +278,17 @@ Examples for FLASH address range in file name:\n\
 boot@0-0x1FFFFF.bin\n\
 user@0x200000-0xFFFFFF.bin\n\
 last@0xFF0000.bin\n\
+\n\
+hash/ files contain sha256 or crc32\n\
+of FLASH range, computed when read.\n\
 \n"
 
-# simplified structure
-# object handle->path and path->object handle
-# caches for every os.ilistdir object
-# pre-filled with custom fs items
-# NOTE for root level objects returned
-# parent object id must be 0 in each storage
-# but we can't have both 0:"/vfs/" and 0:"/custom/"
-# ls("/vfs/") will overwrite oh2path[0]="/vfs/" but
-# path2oh["/custom/"]=0 will remain
-oh2path={
+# custom fs object handle->path
+# handle bits 31:28 !=0, bits 31:24 select
+# readme, fpga, flash or hash directory
+# root level objects have parent 0 in each storage,
+# VFS handles are in oh_* table below
+custom_path={
 0:"/custom/",
 0xc00000f0:"/custom/readme.txt",
 0xc10000d1:"/custom/fpga/",
@@ -290,10 +297,12 @@ oh2path={
 0xc20000f3:"/custom/flash/boot2MB@0-0x1FFFFF.bin",
 0xc20000f4:"/custom/flash/user14MB@0x200000.bin",
 0xc20000f5:"/custom/flash/first4K@0-4095.bin",
+0xc30000d3:"/custom/hash/",
+0xc30000f2:"/custom/hash/full16MB.sha256",
+0xc30000f3:"/custom/hash/boot2MB@0-0x1FFFFF.sha256",
+0xc30000f4:"/custom/hash/user14MB@0x200000.sha256",
+0xc30000f6:"/custom/hash/full16MB.crc32",
 }
-# path2oh is reverse of oh2path, only file names
-path2oh={v:k for k,v in oh2path.items()}
-
 # current ilistdir, pre-filled with custom fs
 # { 1:('main.py',32768,0,123), 2:('lib',16384,0,0), }
 cur_list={}
@@ -305,6 +314,7 @@ custom_cur_list={
 0:{
   0xc10000d1:('fpga',VFS_DIR,0,0),
   0xc20000d2:('flash',VFS_DIR,0,0),
+  0xc30000d3:('hash',VFS_DIR,0,0),
   0xc00000f0:('readme.txt',VFS_FILE,0,len(readme_txt)),
   },
 0xc10000d1:{},
@@ -314,6 +324,13 @@ custom_cur_list={
   0xc20000f4:('user14MB@0x200000.bin',VFS_FILE,0,14*1<<20),
   0xc20000f5:('first4K@0-4095.bin',VFS_FILE,0,4096),
   },
+# hex digest + "\n"
+0xc30000d3:{
+  0xc30000f2:('full16MB.sha256',VFS_FILE,0,65),
+  0xc30000f3:('boot2MB@0-0x1FFFFF.sha256',VFS_FILE,0,65),
+  0xc30000f4:('user14MB@0x200000.sha256',VFS_FILE,0,65),
+  0xc30000f6:('full16MB.crc32',VFS_FILE,0,9),
+  },
 }
 
 # USB PTP "type" 16-bit field
@@ -325,61 +342,280 @@ PTP_USB_CONTAINER_EVENT=const(4)
 
 # response codes, more in libgphoto2 ptp.h
 PTP_RC_OK=const(0x2001)
-#PTP_RC_GeneralError=const(0x2002)
-#PTP_RC_StoreFull=const(0x200C)
+PTP_RC_GeneralError=const(0x2002)
+PTP_RC_InvalidObjectHandle=const(0x2009)
+PTP_RC_StoreFull=const(0x200C)
 PTP_RC_ObjectWriteProtected=const(0x200D)
 PTP_RC_SpecificationByFormatUnsupported=const(0x2014)
+PTP_RC_InvalidParentObject=const(0x201A)
 #PTP_RC_InvalidCodeFormat=const(0x2016)
 #PTP_RC_UnknownVendorCode=const(0x2017)
 #PTP_RC_InvalidDataSet=const(0x2023)
-
-# strip 1 directory level from
-# left slide (first level after root)
-# skip storage name so "/vfs/" becomes "/"
-def strip1dirlvl(path:str)->str:
-  return path[path.find("/",1):]
-
-# list directory items
-# update internal cache path -> object id
-# cache obtained list of objects for later use
-# path is directory with trailing slash
-# recurse in number of subdirs to descend
-def ls(path:str):
-  global next_handle,cur_parent,cur_list
+PTP_RC_MTP_Invalid_ObjectPropCode=const(0xA801)
+PTP_RC_MTP_Specification_By_Group_Unsupported=const(0xA807)
+PTP_RC_MTP_Specification_By_Depth_Unsupported=const(0xA808)
+
+# VFS object handle table, columns indexed by
+# handle bits 19:0, bits 27:20 are generation,
+# incremented when index is reused, so stale handle
+# of host doesn't find other object.
+# index 0 is root "/" with handle 0.
+# directory names end with "/".
+# table is bounded to HANDLE_MAX objects by
+# forgetting least recently listed directories
+# and saved to HANDLE_INDEX at CloseSession
+# so hosts get the same handles after restart
+HANDLE_MAX=const(2048)
+HANDLE_INDEX="/.ptp_handles"
+oh_parent=array("I",[0]) # parent index
+oh_gen=bytearray(1) # generation
+oh_name=[""] # interned name, None: free index
+oh_free=[] # free indexes
+oh_names={} # name->name, same names share one string
+# listed directories index->{name:index}
+# least recently listed first in dir_order
+dir_children={0:{}}
+dir_order=[0]
+oh_dirty=False # table changed since saved
+
+# GetObjectInfo is answered from cached listings
+# of several directories, hosts ask for objects of
+# different directories in turn.
+# GetObjectHandles reads directory again
+LIST_CACHE_BYTES=const(32768) # RAM estimate of cached listings
+LIST_ENTRY_BYTES=const(48) # per entry, without name
+list_cache={} # dir handle->[{handle:ilistdir tuple}, bytes]
+list_order=[] # cached dir handles, least recently used first
+list_bytes=0
+count_ls=0 # os.ilistdir calls
+count_ls_saved=0 # os.ilistdir calls avoided by list_cache
+
+def oh_handle(i:int)->int:
+  return oh_gen[i]<<20|i
+
+# index of VFS handle, -1 if unknown or stale
+def oh_index(oh:int)->int:
+  i=oh&0xFFFFF
+  if i<len(oh_name) and oh_name[i] is not None and oh_gen[i]==oh>>20:
+    return i
+  return -1
+
+# VFS path of index
+def oh_path(i:int)->str:
+  path=""
+  while i:
+    path=oh_name[i]+path
+    i=oh_parent[i]
+  return "/"+path
+
+# move listed directory to most recently used
+def dir_touch(d:int):
+  if d in dir_children:
+    dir_order.remove(d)
+  else:
+    dir_children[d]={}
+  dir_order.append(d)
+
+# index of name in directory d, new if not known,
+# -1 if table is full and nothing can be evicted
+def oh_child(d:int,name:str)->int:
+  global oh_dirty
+  if d not in dir_children:
+    dir_touch(d)
+  children=dir_children[d]
+  i=children.get(name)
+  if i is not None:
+    return i
+  if not oh_free and len(oh_name)>=HANDLE_MAX:
+    oh_evict(d)
+    if not oh_free:
+      return -1
+  name=oh_names.setdefault(name,name)
+  if oh_free:
+    i=oh_free.pop()
+    oh_parent[i]=d
+    oh_name[i]=name
+  else:
+    i=len(oh_name)
+    oh_parent.append(d)
+    oh_gen.append(0)
+    oh_name.append(name)
+  children[name]=i
+  oh_dirty=True
+  return i
+
+# free index, listing of it and everything below
+def oh_drop(i:int):
+  global oh_dirty
+  children=dir_children.pop(i,None)
+  if children is not None:
+    list_forget(oh_handle(i))
+    dir_order.remove(i)
+    for j in children.values():
+      oh_drop(j)
+  oh_name[i]=None
+  oh_gen[i]=(oh_gen[i]+1)&0xFF
+  oh_free.append(i)
+  oh_dirty=True
+
+# forget least recently used directory listings
+# until 1/8 of table is free. directory d,
+# current directory and their parents stay
+def oh_evict(d:int):
+  keep=[]
+  for i in (d,oh_index(cur_parent)):
+    while i>0:
+      keep.append(i)
+      i=oh_parent[i]
+  for e in dir_order[:]:
+    if len(oh_free)>=HANDLE_MAX>>3:
+      break
+    if e and e not in keep and e in dir_children:
+      list_forget(oh_handle(e))
+      dir_order.remove(e)
+      for j in dir_children.pop(e).values():
+        oh_drop(j)
+  oh_names.clear()
+  for name in oh_name:
+    if name:
+      oh_names[name]=name
+
+def oh_save():
+  global oh_dirty
+  if not oh_dirty:
+    return
   try:
-    dir=os.ilistdir(strip1dirlvl(path))
+    with open(HANDLE_INDEX,"wb") as f:
+      f.write(struct.pack("<L",len(oh_name)))
+      f.write(oh_parent)
+      f.write(oh_gen)
+      f.write("\n".join([name or "" for name in oh_name]).encode())
+    oh_dirty=False
+  except OSError:
+    print("can't save %s" % HANDLE_INDEX)
+
+def oh_load():
+  global oh_parent,oh_gen,oh_name,oh_free,dir_children,dir_order
+  try:
+    with open(HANDLE_INDEX,"rb") as f:
+      n=struct.unpack("<L",f.read(4))[0]
+      parents=array("I",[0]*n)
+      gen=bytearray(n)
+      f.readinto(parents)
+      f.readinto(gen)
+      names=f.read().decode().split("\n")
   except:
     return
-  if path in path2oh:
-    cur_parent=path2oh[path]
-  else:
-    cur_parent=next_handle
-    next_handle+=1
-    path2oh[path]=cur_parent
-    oh2path[cur_parent]=path
+  if len(names)!=n:
+    return
+  oh_parent,oh_gen,oh_name,oh_free=parents,gen,[""],[]
+  dir_children={0:{}}
+  for i in range(1,n):
+    name=names[i]
+    if name:
+      name=oh_names.setdefault(name,name)
+      oh_name.append(name)
+      if parents[i] not in dir_children:
+        dir_children[parents[i]]={}
+      dir_children[parents[i]][name]=i
+    else:
+      oh_name.append(None)
+      oh_free.append(i)
+  dir_order=list(dir_children)
+
+def list_forget(oh:int):
+  global list_bytes,cur_parent
+  entry=list_cache.pop(oh,None)
+  if entry:
+    list_order.remove(oh)
+    list_bytes-=entry[1]
+  if oh==cur_parent: # cur_list may be stale
+    cur_parent=-1
+
+def list_put(oh:int,listing):
+  global list_bytes
+  list_forget(oh)
+  size=0
+  for obj in listing.values():
+    size+=LIST_ENTRY_BYTES+len(obj[0])
+  list_cache[oh]=[listing,size]
+  list_order.append(oh)
+  list_bytes+=size
+  while list_bytes>LIST_CACHE_BYTES and len(list_order)>1:
+    list_forget(list_order[0])
+
+# set object objh in cached listing of directory oh,
+# obj None removes it. keeps list_bytes equal to the sum
+def list_set(oh:int,objh:int,obj):
+  global list_bytes
+  entry=list_cache.get(oh)
+  if entry is None:
+    return
+  old=entry[0].pop(objh,None)
+  if old:
+    entry[1]-=LIST_ENTRY_BYTES+len(old[0])
+    list_bytes-=LIST_ENTRY_BYTES+len(old[0])
+  if obj:
+    entry[0][objh]=obj
+    entry[1]+=LIST_ENTRY_BYTES+len(obj[0])
+    list_bytes+=LIST_ENTRY_BYTES+len(obj[0])
+
+def report():
+  print("ls: %d ilistdir, %d saved, %d dirs %d bytes cached" % (count_ls,count_ls_saved,len(list_order),list_bytes))
+
+# list VFS directory with handle oh
+# cache obtained list of objects for later use
+# objects no longer in directory are forgotten
+# cached: listing from list_cache if there
+def ls(oh:int,cached:bool=False)->bool:
+  global cur_parent,cur_list,count_ls,count_ls_saved
+  d=oh_index(oh)
+  if d<0:
+    list_forget(oh)
+    return False
+  if cached and oh in list_cache:
+    dir_touch(d)
+    list_order.remove(oh)
+    list_order.append(oh)
+    if oh!=cur_parent:
+      count_ls_saved+=1
+    cur_parent=oh
+    cur_list=list_cache[oh][0]
+    return True
+  try:
+    dir=os.ilistdir(oh_path(d))
+  except:
+    return False
+  count_ls+=1
+  dir_touch(d)
   cur_list={}
   for obj in dir:
-    if obj[1]==VFS_FILE:
-      objname=obj[0]
+    objname=obj[0]
     if obj[1]==VFS_DIR:
-      objname=obj[0]+"/"
-    fullpath=path+objname
-    if fullpath in path2oh:
-      oh=path2oh[fullpath]
-    else:
-      oh=next_handle
-      next_handle+=1
-      path2oh[fullpath]=oh
-      oh2path[oh]=fullpath
-    cur_list[oh]=obj
-    #print(oh,fullpath,obj)
+      objname+="/"
+    elif d==0 and objname==HANDLE_INDEX[1:]:
+      continue
+    i=oh_child(d,objname)
+    if i<0: # table full, rest of directory is not listed
+      continue
+    cur_list[oh_handle(i)]=obj
+  children=dir_children[d]
+  if len(children)>len(cur_list):
+    for name in [name for name in children if oh_handle(children[name]) not in cur_list]:
+      oh_drop(children.pop(name))
+  list_put(oh,cur_list)
+  cur_parent=oh
+  return True
 
 # for a given object id return
 # its parent directory
 def parent(oh:int)->int:
-  path=oh2path[oh]
-  pp=path[:path[:-1].rfind("/")+1]
-  return path2oh[pp]
+  if oh>>28: # custom
+    for p in custom_cur_list:
+      if oh in custom_cur_list[p]:
+        return p
+    return 0
+  return oh_handle(oh_parent[oh&0xFFFFF])
 
 # fromto@4096-0x3FFF.bin
 # from@0x200000.rom
@@ -450,6 +686,21 @@ def get_ucs2_string(s):
 def uint32_array(a):
   return struct.pack("<L"+"L"*len(a),len(a),*a)
 
+# objecthandle array as generator of 256-byte
+# pieces for in_data(), any number of handles
+def uint32_stream(a):
+  yield struct.pack("<L",len(a))
+  b=bytearray(256)
+  i=0
+  for x in a:
+    struct.pack_into("<L",b,i,x)
+    i+=4
+    if i==len(b):
+      yield b
+      i=0
+  if i:
+    yield memoryview(b)[:i]
+
 # for immediate response IN "ok"
 def hdr_ok():
   hdr.len=12
@@ -465,6 +716,11 @@ def in_hdr_write_protected():
   hdr.code=PTP_RC_ObjectWriteProtected
   usbd.submit_xfer(PTP_DATA_IN,memoryview(ptp_buf)[:hdr.len])
 
+def in_hdr_code(code:int):
+  hdr_ok()
+  hdr.code=code
+  usbd.submit_xfer(PTP_DATA_IN,memoryview(ptp_buf)[:hdr.len])
+
 def in_end_sendobject(ok):
   hdr.type=PTP_USB_CONTAINER_RESPONSE
   hdr.txid=txid
@@ -479,18 +735,57 @@ def in_end_sendobject(ok):
     hdr.len=12
   usbd.submit_xfer(PTP_DATA_IN, memoryview(ptp_buf)[:hdr.len])
 
-def in_hdr_data_ok(data):
-  hdr.len=12+len(data)
+# data phase of any length: gen yields bytes pieces,
+# total length bytes. header and pieces are packed
+# into ptp_buf, each full ptp_buf is one bulk IN
+# transfer, in_data_next() continues when host has
+# read it. response OK follows the last transfer
+data_gen=None
+data_rest=b"" # part of piece not yet in ptp_buf
+data_left=0 # bytes of data phase not yet in ptp_buf
+
+def in_data(gen,length:int):
+  global txid,data_gen,data_rest,data_left
+  txid=hdr.txid
+  hdr.len=12+length
   hdr.type=PTP_USB_CONTAINER_DATA
-  ptp_buf[12:hdr.len]=data
+  data_gen=iter(gen)
+  data_rest=b""
+  data_left=length
+  in_data_fill(12)
+
+def in_data_fill(pos:int):
+  global data_gen,data_rest,data_left
+  mv=memoryview(ptp_buf)
+  while pos<len(ptp_buf) and data_left>0:
+    if not data_rest:
+      try:
+        data_rest=memoryview(next(data_gen))
+      except StopIteration: # shorter than promised
+        data_left=0
+        break
+    n=min(len(data_rest),len(ptp_buf)-pos,data_left)
+    mv[pos:pos+n]=data_rest[:n]
+    data_rest=data_rest[n:]
+    data_left-=n
+    pos+=n
+  if data_left>0:
+    ep_cb[PTP_DATA_IN]=in_data_next
+  else:
+    data_gen=None
+    data_rest=b""
+    ep_cb[PTP_DATA_IN]=in_end_data
   #print(">",end="")
-  #print_hex(ptp_buf[:hdr.len])
-  usbd.submit_xfer(PTP_DATA_IN, memoryview(ptp_buf)[:hdr.len])
-  ep_cb[PTP_DATA_IN]=in_ok
+  #print_hex(ptp_buf[:pos])
+  usbd.submit_xfer(PTP_DATA_IN,mv[:pos])
+
+def in_hdr_data_ok(data):
+  in_data((data,),len(data))
 
 def OpenSession(cnt):
   global sesid
   sesid=hdr.p1
+  hash_cache.clear() # flash may be written by other tools
   in_hdr_ok()
 
 # event codes, more in libgphoto2 ptp.h
@@ -608,17 +903,12 @@ def GetObjectHandles(cnt): # 0x1007
   if dirhandle==0xFFFFFFFF: # root directory
     dirhandle=0
   if storageid==STORID_VFS:
-    if dirhandle==0:
-      ls("/vfs/")
-    else:
-      ls(oh2path[dirhandle])
+    if not ls(dirhandle):
+      cur_list={}
   if storageid==STORID_CUSTOM:
     cur_list=custom_cur_list[dirhandle]
-  data=uint32_array(cur_list)
-  # FIXME when directory has many entries > 256 data
-  # would not fit in one 4160 byte block
-  # block continuation neede
-  in_hdr_data_ok(data)
+  # any number of entries, sent in many 4160 byte blocks
+  in_data(uint32_stream(cur_list),4+4*len(cur_list))
 
 # PTP_oi_StorageID		 0
 # PTP_oi_ObjectFormat		 4
@@ -638,49 +928,58 @@ def GetObjectHandles(cnt): # 0x1007
 # PTP_oi_filenamelen		52
 # PTP_oi_Filename               53
 
+# ilistdir tuple of object from custom fs or
+# listing of parent: list_cache or ls(parent)
+# if cached listing is older. None if not found
+def oh_obj(objh:int,ParentObject:int):
+  if objh>>28:
+    return custom_cur_list[ParentObject].get(objh)
+  if not (ls(ParentObject,True) and objh in cur_list):
+    if not ls(ParentObject):
+      return None
+  return cur_list.get(objh)
+
+# readme and hash/ can't be written or deleted
+def obj_protected(objh:int)->int:
+  if objh==0xc00000f0 or objh>>24==0xc3:
+    return 1
+  return 0
+
+def obj_format(obj)->int:
+  if obj[1]==VFS_DIR:
+    return PTP_OFC_Directory
+  if obj[0].endswith(".txt"):
+    return PTP_OFC_Text
+  return PTP_OFC_Defined
+
 def GetObjectInfo(cnt): # 0x1008
-  global cur_list
-  objh=hdr.p1 # FIXME optimize code
-  # if object handle has different parent
-  # it is probably not in cur_list, so
-  # update cur_list with ls(parent)
-  this_parent=parent(objh)
-  if this_parent in oh2path:
-    if this_parent!=cur_parent:
-      if objh>>28: # custom
-        cur_list=custom_cur_list[this_parent]
-      else: # vfs
-        ls(oh2path[this_parent])
+  objh=hdr.p1
   #print("objh=%08x" % objh)
   ObjectFormat=PTP_OFC_Text
   thumb_image_null=bytearray(26)
   assoc_seq_null=bytearray(10)
-  if objh in oh2path:
-    fullpath=oh2path[objh]
-    ParentObject=parent(objh) # 0 means this file is in root directory
+  if objh>>28==0 and oh_index(objh)<=0 \
+  or objh>>28 and objh not in custom_path:
+    in_hdr_code(PTP_RC_InvalidObjectHandle)
+    return
+  ParentObject=parent(objh) # 0 means this file is in root directory
+  obj=oh_obj(objh,ParentObject)
+  if obj:
     if objh>>28: # member of custom fs
       StorageID=STORID_CUSTOM
-      objname,objtype,_,objsize=custom_cur_list[ParentObject][objh]
     else: # high nibble=0 vfs
       StorageID=STORID_VFS
-      objname,objtype,_,objsize=cur_list[objh]
+    objname,objtype,_,objsize=obj
     #objtype,_,_,_,_,_,objsize,_,_,_=os.stat(fullpath)
     #objname=fullpath[fullpath.rfind("/")+1:]
     #objname=basename(objh)
     #if fullpath[-1]=="/": # dir
+    ObjectFormat=obj_format(obj)
     if objtype==VFS_DIR: # dir
-      ObjectFormat=PTP_OFC_Directory
       ObjectSize=0
     else: # stat[0]==VFS_FILE # file
-      if fullpath.endswith(".txt"):
-        ObjectFormat=PTP_OFC_Text
-      else:
-        ObjectFormat=PTP_OFC_Defined
       ObjectSize=objsize
-    if objh==0xc00000f0: # readme
-      ProtectionStatus=1 # ro
-    else:
-      ProtectionStatus=0 # 0:rw
+    ProtectionStatus=obj_protected(objh) # 0:rw 1:ro
     #if objh&0xFF==0xf1 or objh&0xFF==0xf2: # file fpga or flash
     #  ObjectFormat=PTP_OFC_Undefined
     hdr1=struct.pack("<LHHL",StorageID,ObjectFormat,ProtectionStatus,ObjectSize)
@@ -696,76 +995,311 @@ def GetObjectInfo(cnt): # 0x1008
     #data=hdr1+thumb_image_null+hdr2+assoc_seq_null+name+b"\0\0\0"
     data=hdr1+thumb_image_null+hdr2+assoc_seq_null+name+create+modify+b"\0"
     in_hdr_data_ok(data)
+  else:
+    in_hdr_code(PTP_RC_InvalidObjectHandle)
+
+# MTP object properties, more in libgphoto2 ptp.h
+MTP_OPC_StorageID=const(0xDC01)
+MTP_OPC_ObjectFormat=const(0xDC02)
+MTP_OPC_ProtectionStatus=const(0xDC03)
+MTP_OPC_ObjectSize=const(0xDC04)
+MTP_OPC_ObjectFileName=const(0xDC07)
+MTP_OPC_ParentObject=const(0xDC0B)
+# datatype codes
+PTP_DTC_UINT16=const(0x0004)
+PTP_DTC_UINT32=const(0x0006)
+PTP_DTC_UINT64=const(0x0008)
+PTP_DTC_STR=const(0xFFFF)
+
+# supported object properties:
+# datatype, struct format of value (None: string)
+obj_props={
+  MTP_OPC_StorageID:(PTP_DTC_UINT32,"<L"),
+  MTP_OPC_ObjectFormat:(PTP_DTC_UINT16,"<H"),
+  MTP_OPC_ProtectionStatus:(PTP_DTC_UINT16,"<H"),
+  MTP_OPC_ObjectSize:(PTP_DTC_UINT64,"<Q"),
+  MTP_OPC_ObjectFileName:(PTP_DTC_STR,None),
+  MTP_OPC_ParentObject:(PTP_DTC_UINT32,"<L"),
+}
+
+# packed value of property for object objh
+# obj is ilistdir tuple from cur_list or custom_cur_list
+def obj_prop_value(prop:int,objh:int,objparent:int,obj)->bytes:
+  if prop==MTP_OPC_ObjectFileName:
+    return ucs2_string(obj[0].encode())
+  if prop==MTP_OPC_StorageID:
+    v=STORID_CUSTOM if objh>>28 else STORID_VFS
+  elif prop==MTP_OPC_ObjectFormat:
+    v=obj_format(obj)
+  elif prop==MTP_OPC_ProtectionStatus:
+    v=obj_protected(objh)
+  elif prop==MTP_OPC_ObjectSize:
+    v=0 if obj[1]==VFS_DIR else obj[3]
+  else: # MTP_OPC_ParentObject
+    v=objparent
+  return struct.pack(obj_props[prop][1],v)
+
+def GetObjectPropsSupported(cnt): # 0x9801
+  # same properties for any format hdr.p1
+  in_hdr_data_ok(uint16_array(obj_props))
+
+def GetObjectPropDesc(cnt): # 0x9802
+  prop=hdr.p1
+  if prop not in obj_props:
+    in_hdr_code(PTP_RC_MTP_Invalid_ObjectPropCode)
+    return
+  datatype,fmt=obj_props[prop]
+  default=struct.pack(fmt,0) if fmt else b"\0"
+  # get only, group 0, no form
+  data=struct.pack("<HHB",prop,datatype,0)+default+struct.pack("<LB",0,0)
+  in_hdr_data_ok(data)
+
+def GetObjectPropValue(cnt): # 0x9803
+  objh=hdr.p1
+  prop=hdr.p2
+  if prop not in obj_props:
+    in_hdr_code(PTP_RC_MTP_Invalid_ObjectPropCode)
+    return
+  if objh>>28==0 and oh_index(objh)<=0 \
+  or objh>>28 and objh not in custom_path:
+    in_hdr_code(PTP_RC_InvalidObjectHandle)
+    return
+  objparent=parent(objh)
+  obj=oh_obj(objh,objparent)
+  if obj:
+    in_hdr_data_ok(obj_prop_value(prop,objh,objparent,obj))
+  else:
+    in_hdr_code(PTP_RC_InvalidObjectHandle)
+
+# GetObjectPropList elements of all objects
+# in groups of (parent,{handle:ilistdir tuple})
+# format ofc or any format if ofc==0
+def obj_prop_stream(groups,props,ofc:int,count:int):
+  yield struct.pack("<L",count)
+  for objparent,objs in groups:
+    for objh in objs:
+      obj=objs[objh]
+      if ofc and obj_format(obj)!=ofc:
+        continue
+      data=b""
+      for prop in props:
+        data+=struct.pack("<LHH",objh,prop,obj_props[prop][0])+obj_prop_value(prop,objh,objparent,obj)
+      yield data
+
+# properties of one object (depth 0) or of all objects
+# in a directory (depth 1) in one data phase, instead
+# of GetObjectInfo for each. objh 0 or 0xFFFFFFFF with
+# depth 1 is root of both storages.
+# whole tree (depth 0xFFFFFFFF) is not supported,
+# host then falls back to GetObjectHandles
+def GetObjectPropList(cnt): # 0x9805
+  objh=hdr.p1
+  ofc=hdr.p2 # object format, 0: any
+  prop=hdr.p3 # 0xFFFFFFFF: all, 0: by group
+  depth=hdr.p5 if hdr.len>=32 else 0
+  if prop==0:
+    in_hdr_code(PTP_RC_MTP_Specification_By_Group_Unsupported)
+    return
+  if prop==0xFFFFFFFF:
+    props=tuple(obj_props)
+  elif prop in obj_props:
+    props=(prop,)
+  else:
+    in_hdr_code(PTP_RC_MTP_Invalid_ObjectPropCode)
+    return
+  groups=None
+  if depth==0 and objh!=0xFFFFFFFF:
+    if objh>>28 and objh in custom_path \
+    or objh>>28==0 and oh_index(objh)>0:
+      objparent=parent(objh)
+      obj=oh_obj(objh,objparent)
+      if obj:
+        groups=((objparent,{objh:obj}),)
+  elif depth==1:
+    if objh==0 or objh==0xFFFFFFFF:
+      groups=[(0,custom_cur_list[0])]
+      if ls(0,True):
+        groups.insert(0,(0,cur_list))
+    elif objh>>28:
+      if objh in custom_cur_list:
+        groups=((objh,custom_cur_list[objh]),)
+    elif ls(objh,True):
+      groups=((objh,cur_list),)
+  else:
+    in_hdr_code(PTP_RC_MTP_Specification_By_Depth_Unsupported)
+    return
+  if groups is None:
+    in_hdr_code(PTP_RC_InvalidObjectHandle)
+    return
+  # data length from fixed size values and name lengths
+  fixed=0
+  strings=0
+  for prop in props:
+    fmt=obj_props[prop][1]
+    if fmt:
+      fixed+=8+struct.calcsize(fmt)
+    else:
+      strings+=1
+  count=0
+  length=4
+  for objparent,objs in groups:
+    for objh in objs:
+      obj=objs[objh]
+      if ofc and obj_format(obj)!=ofc:
+        continue
+      count+=1
+      length+=fixed
+      if strings:
+        n=len(obj[0].encode())
+        length+=strings*(8+(1+2*(n+1) if n else 1))
+  in_data(obj_prop_stream(groups,props,ofc,count*len(props)),length)
 
 def GetObject(cnt): # 0x1009
-  global txid,remain_getobj_len,fd,addr
+  global txid,remain_getobj_len,fd,addr,flash_reader
   txid=hdr.txid
-  if hdr.p1 in oh2path:
-    fullpath=oh2path[hdr.p1]
-    if fullpath.startswith("/"+STORAGE[STORID_VFS].decode()):
-      fd=open(strip1dirlvl(fullpath),"rb")
-      filesize=fd.seek(0,2)
-      fd.seek(0)
-      len1st=fd.readinto(memoryview(ptp_buf)[12:])
-      # file data after 12-byte header
+  if hdr.p1>>28==0 and oh_index(hdr.p1)<=0 \
+  or hdr.p1>>28 and hdr.p1 not in custom_path:
+    in_hdr_code(PTP_RC_InvalidObjectHandle)
+    return
+  if hdr.p1>>28==0: # vfs
+    try:
+      fd=open(oh_path(oh_index(hdr.p1)),"rb")
+    except OSError: # directory or removed meanwhile
+      in_hdr_code(PTP_RC_InvalidObjectHandle)
+      return
+    filesize=fd.seek(0,2)
+    fd.seek(0)
+    len1st=fd.readinto(memoryview(ptp_buf)[12:])
+    # file data after 12-byte header
+    length=12+len1st
+    remain_getobj_len=filesize-len1st
+    ep_cb[PTP_DATA_IN]=in_get_file
+    if remain_getobj_len<=0:
+      remain_getobj_len=0
+      fd.close()
+      ep_cb[PTP_DATA_IN]=in_end_data
+  else: # custom
+    fullpath=custom_path[hdr.p1]
+    if hdr.p1>>24==0xc1 or hdr.p1>>24==0xc0: # fpga or readme
+      msg=readme_txt
+      filesize=len(msg)
+      length=12+filesize
+      remain_getobj_len=0
+      memoryview(ptp_buf)[12:12+len(msg)]=msg
+      ep_cb[PTP_DATA_IN]=in_end_data
+    if hdr.p1>>24==0xc3: # flash hash
+      if hdr.p1 in hash_cache:
+        in_hdr_data_ok(hash_cache[hdr.p1])
+      else:
+        hash_start(hdr.p1) # data IN when hash is done
+      return
+    if hdr.p1>>24==0xc2: # flash
+      name2addr(fullpath)
+      filesize=addr_last+1-addr
+      if filesize<4096:
+        len1st=filesize
+      else:
+        len1st=4096
       length=12+len1st
       remain_getobj_len=filesize-len1st
-      ep_cb[PTP_DATA_IN]=in_get_file
+      ecp5.flash_open()
+      flash_reader=ecp5.flash_reader(addr,filesize)
+      flash_reader.readinto(memoryview(ptp_buf)[12:12+len1st])
       if remain_getobj_len<=0:
         remain_getobj_len=0
-        fd.close()
-        ep_cb[PTP_DATA_IN]=in_end_getobject
-    if fullpath.startswith("/"+STORAGE[STORID_CUSTOM].decode()):
-      if hdr.p1>>24==0xc1 or hdr.p1>>24==0xc0: # fpga or readme
-        msg=readme_txt
-        filesize=len(msg)
-        length=12+filesize
-        remain_getobj_len=0
-        memoryview(ptp_buf)[12:12+len(msg)]=msg
-        ep_cb[PTP_DATA_IN]=in_end_getobject
-      if hdr.p1>>24==0xc2: # flash
-        name2addr(fullpath)
-        filesize=addr_last+1-addr
-        if filesize<4096:
-          len1st=filesize
-        else:
-          len1st=4096
-        length=12+len1st
-        remain_getobj_len=filesize-len1st
-        ecp5.flash_open()
-        ecp5.flash_read_block(memoryview(ptp_buf)[12:12+len1st],addr)
-        addr+=len1st
-        if remain_getobj_len<=0:
-          remain_getobj_len=0
-          ecp5.flash_close()
-          ep_cb[PTP_DATA_IN]=in_end_getobject
-        else:
-          ep_cb[PTP_DATA_IN]=in_get_flash
-    hdr.len=12+filesize
-    hdr.type=PTP_USB_CONTAINER_DATA
+        flash_reader.close()
+        ecp5.flash_close()
+        ep_cb[PTP_DATA_IN]=in_end_data
+      else:
+        ep_cb[PTP_DATA_IN]=in_get_flash
+  hdr.len=12+filesize
+  hdr.type=PTP_USB_CONTAINER_DATA
   usbd.submit_xfer(PTP_DATA_IN, memoryview(ptp_buf)[:length])
 
+# flash hash/ files: hash of up to 16MB is computed
+# in slices run by micropython.schedule, not all at
+# once in the USB callback. host waits for data IN.
+# results are kept until flash is written or session ends
+HASH_SLICE=const(65536) # bytes per scheduled slice
+hash_cache={} # handle: b"hexdigest\n"
+hash_job=None # [handle, hash, flash_reader, bytes remaining]
+
+def hash_start(oh:int):
+  global hash_job
+  fullpath=custom_path[oh]
+  name2addr(fullpath)
+  algo=fullpath[fullpath.rfind(".")+1:]
+  ecp5.flash_open()
+  hash_job=[oh,hashsum.hash_new(algo),ecp5.flash_reader(addr,addr_last+1-addr),addr_last+1-addr]
+  micropython.schedule(hash_slice,0)
+
+def hash_slice(_):
+  global hash_job
+  oh,h,reader,remain=hash_job
+  # ptp_buf after header is free until data IN
+  mv=memoryview(ptp_buf)[12:12+4096]
+  try:
+    n=0
+    while n<HASH_SLICE and remain>0:
+      r=reader.readinto(mv[:min(len(mv),remain)])
+      if r==0:
+        raise OSError(5)
+      h.update(mv[:r])
+      remain-=r
+      n+=r
+  except:
+    remain=-1
+  hash_job[3]=remain
+  if remain>0:
+    micropython.schedule(hash_slice,0)
+    return
+  reader.close()
+  ecp5.flash_close()
+  hash_job=None
+  if remain<0:
+    in_hdr_code(PTP_RC_GeneralError)
+    return
+  from binascii import hexlify
+  hash_cache[oh]=hexlify(h.digest())+b"\n"
+  in_hdr_data_ok(hash_cache[oh])
+
 # delete object by handle
+# listings are changed after the object is gone
 def ohdel(oh):
-  fullpath=oh2path[oh]
-  del(oh2path[oh])
-  if oh in cur_list:
-    del(cur_list[oh])
-  del(path2oh[fullpath])
-  if oh>>28==0: # VFS
-    os.unlink(strip1dirlvl(fullpath))
+  if oh>>28: # custom
+    cur_list.pop(oh,None)
+    del(custom_cur_list[parent(oh)][oh])
+    del(custom_path[oh])
+    return
+  i=oh_index(oh)
+  fullpath=oh_path(i)
+  if fullpath.endswith("/"):
+    os.rmdir(fullpath[:-1])
+  else:
+    os.unlink(fullpath)
+  list_set(parent(oh),oh,None)
+  cur_list.pop(oh,None) # if not cached
+  del(dir_children[oh_parent[i]][oh_name[i]])
+  oh_drop(i)
 
 def DeleteObject(cnt): # 0x100B
-  if hdr.p1==0xc00000f0: # readme
+  if obj_protected(hdr.p1): # readme or hash
     in_hdr_write_protected()
+  elif hdr.p1>>28==0 and oh_index(hdr.p1)<=0 \
+  or hdr.p1>>28 and hdr.p1 not in custom_path:
+    in_hdr_code(PTP_RC_InvalidObjectHandle)
   else:
-    ohdel(hdr.p1)
+    try:
+      ohdel(hdr.p1)
+    except OSError: # directory not empty
+      in_hdr_code(PTP_RC_GeneralError)
+      return
     #print("deleted",fullpath)
     in_hdr_ok()
 
 def SendObjectInfo(cnt): # 0x100C
   global txid,send_length,send_name,next_handle,current_send_handle
-  global send_parent,send_parent_path,send_fullpath
+  global send_parent,send_fullpath
   global current_storid
   txid=hdr.txid
   if hdr.type==PTP_USB_CONTAINER_COMMAND: # 1
@@ -777,8 +1311,6 @@ def SendObjectInfo(cnt): # 0x100C
     if send_parent==0xffffffff:
       send_parent=0
     #print("send_parent: 0x%x" % send_parent)
-    send_parent_path=oh2path[send_parent]
-    #print("send dir path",send_parent_path)
     # prepare full buffer to read from host again
     # host will send another OUT
     usbd.submit_xfer(PTP_DATA_OUT, ptp_buf)
@@ -793,38 +1325,51 @@ def SendObjectInfo(cnt): # 0x100C
     #print("send name:", str_send_name)
     #send_length,=struct.unpack("<L", cnt[20:24])
     send_length=hdr.p3
-    send_fullpath=oh2path[send_parent]+str_send_name
     #if send_length<=0:
     #  print("host send length",send_length)
-    #  print("fullpath",send_fullpath)
-    if send_fullpath in path2oh:
-      current_send_handle=path2oh[send_fullpath]
-    else:
-      # HACK copy parent's upper byte, used for custom fs
-      # for objects to keep bits 31:24 of parent id in
-      # bits 31:24 of new handle id
-      current_send_handle=next_handle|(send_parent&0xFF000000)
-      next_handle+=1
-      #str_send_name_p2h=str_send_name
-      send_fullpath_h2p=send_fullpath
-      vfstype=VFS_FILE
-      if send_objtype==PTP_OFC_Directory: # new dir
-        vfstype=VFS_DIR
-        #str_send_name_p2h+="/"
-        send_fullpath_h2p+="/"
-        os.mkdir(strip1dirlvl(send_fullpath))
-      path2oh[send_fullpath_h2p]=current_send_handle
-      oh2path[current_send_handle]=send_fullpath_h2p
-      if current_send_handle>>28: # !=0 custom
+    vfstype=VFS_FILE
+    if send_objtype==PTP_OFC_Directory: # new dir
+      vfstype=VFS_DIR
+    if current_storid==STORID_CUSTOM:
+      if send_parent not in custom_cur_list:
+        in_hdr_code(PTP_RC_InvalidParentObject)
+        return
+      # custom path without "/custom"
+      send_fullpath=custom_path[send_parent][7:]+str_send_name
+      current_send_handle=0
+      for oh in custom_cur_list[send_parent]:
+        if custom_cur_list[send_parent][oh][0]==str_send_name:
+          current_send_handle=oh
+      if current_send_handle==0:
+        # HACK copy parent's upper byte, used for custom fs
+        # for objects to keep bits 31:24 of parent id in
+        # bits 31:24 of new handle id
+        current_send_handle=next_handle|(send_parent&0xFF000000)
+        next_handle+=1
+        custom_path[current_send_handle]="/custom"+send_fullpath
         custom_cur_list[send_parent][current_send_handle]=(str_send_name,vfstype,0,send_length)
-      else: # ==0 vfs
-        cur_list[current_send_handle]=(str_send_name,vfstype,0,send_length)
-      #path2handle[send_parent_path][str_send_name_p2h]=current_send_handle
-      #handle2path[current_send_handle]=send_fullpath_h2p
-    vfs_objtype=VFS_FILE # default is file
-    if send_objtype==PTP_OFC_Directory:
-      vfs_objtype=VFS_DIR # directory
-    #dir2handle[send_parent][current_send_handle]=(str_send_name,vfs_objtype,0,send_length)
+    else: # vfs
+      # new object joins cur_list, the cached listing of parent
+      d=oh_index(send_parent)
+      if d<0 or not ls(send_parent,True):
+        in_hdr_code(PTP_RC_InvalidParentObject)
+        return
+      objname=str_send_name
+      if vfstype==VFS_DIR:
+        objname+="/"
+      i=oh_child(d,objname)
+      if i<0:
+        in_hdr_code(PTP_RC_StoreFull)
+        return
+      current_send_handle=oh_handle(i)
+      send_fullpath=oh_path(i)
+      #print("fullpath",send_fullpath)
+      if vfstype==VFS_DIR:
+        try:
+          os.mkdir(send_fullpath[:-1])
+        except OSError: # exists
+          pass
+      list_set(send_parent,current_send_handle,(str_send_name,vfstype,0,send_length))
     #print("current send handle",current_send_handle)
     # send OK response to host
     hdr_ok()
@@ -838,18 +1383,51 @@ def SendObjectInfo(cnt): # 0x100C
     #print_hex(ptp_buf[:hdr.len])
     usbd.submit_xfer(PTP_DATA_IN, memoryview(ptp_buf)[:hdr.len])
 
+# append USB OUT data to flash ring
+def ring_write(data):
+  global ring_wr
+  n=len(data)
+  pos=ring_wr&0x1FFF
+  first=min(n,0x2000-pos)
+  flash_ring[pos:pos+first]=data[:first]
+  flash_ring[:n-first]=data[first:]
+  ring_wr+=n
+
+# flash whole blocks from ring
+# last: pad the rest with 0xFF to full block
+# after a failed block the rest is received but not flashed,
+# failure is reported at the end of SendObject
+def ring_flash(last:bool)->bool:
+  global ring_rd,addr,ring_ok
+  if last and ring_wr&0xFFF:
+    ring_write(b"\xff"*(0x1000-(ring_wr&0xFFF)))
+  while ring_wr-ring_rd>=4096:
+    pos=ring_rd&0x1FFF
+    if ring_ok and not ecp5.flash_write_block_retry(memoryview(flash_ring)[pos:pos+4096],addr):
+      ring_ok=False
+    ring_rd+=4096
+    addr+=4096
+  return ring_ok
+
 def close_sendobject()->bool:
+  global flash_ring
   if send_parent>>24==0xc1: # fpga
     return ecp5.prog_close()
   elif send_parent>>24==0xc2: # flash
+    ok=ring_flash(True)
+    flash_ring=None
+    hash_cache.clear()
     ecp5.flash_close()
+    return ok
     #ecp5.flash_report()
   else:
     fd.close()
+    list_forget(send_parent) # file size from ilistdir
   return True
 
 def SendObject(cnt): # 0x100D
   global txid,send_length,remaining_send_length,addr,fd
+  global flash_ring,ring_rd,ring_wr,ring_ok
   txid=hdr.txid
   if hdr.type==PTP_USB_CONTAINER_COMMAND: # 1
     # host will send another OUT command
@@ -865,23 +1443,15 @@ def SendObject(cnt): # 0x100D
         #print_hexdump(hashlib.md5(cnt[12:]).digest())
       elif send_parent>>24==0xc2: # flash
         ecp5.flash_open()
-        # first packet is read in 4160=4096+64 bytes buffer
-        # buf[0:12] header
-        # buf[12:4108] 4096 bytes flash
-        # buf[4108:4160] 52 bytes of next flash payload
-        # pad with 0xFF if flash shorter than 4096
-        # after flashing first block, copy buf[4108:4160] to buf[0:52]
-        # schecule read of every next packet 4096 bytes to buf[52:4148]
-        # flash buf[0:4096]
-        # copy buf[4096:4148] to buf[0:52]
-        # last packet: pad with 0xFF if shorter than 4096
-        if len(cnt)<4108:
-          memoryview(ptp_buf)[len(cnt):4108]=bytearray(b"\xff"*(4108-len(cnt)))
-        ecp5.flash_write_block_retry(memoryview(ptp_buf)[12:4108],addr&0xFFF000)
-        memoryview(ptp_buf)[:52]=ptp_buf[4108:4160]
-        addr+=4096
+        # first packet has 12 byte header and up to
+        # 4148 bytes payload, ring holds 2 blocks
+        addr&=0xFFF000
+        flash_ring=bytearray(0x2000)
+        ring_rd=ring_wr=0
+        ring_ok=True
+        ring_write(memoryview(cnt)[12:])
       else:
-        fd=open(strip1dirlvl(send_fullpath),"wb")
+        fd=open(send_fullpath,"wb")
         fd.write(cnt[12:])
       remaining_send_length=send_length-(len(cnt)-12)
       send_length=0
@@ -906,7 +1476,8 @@ def SendObject(cnt): # 0x100D
         usbd.submit_xfer(PTP_DATA_OUT,ptp_buf)
       elif send_parent>>24==0xc2: # flash
         ep_cb[PTP_DATA_OUT]=out_flash
-        usbd.submit_xfer(PTP_DATA_OUT,memoryview(ptp_buf)[52:4148])
+        usbd.submit_xfer(PTP_DATA_OUT,memoryview(ptp_buf)[:4096])
+        ring_flash(False)
       else: # file
         ep_cb[PTP_DATA_OUT]=out_file
         usbd.submit_xfer(PTP_DATA_OUT,ptp_buf)
@@ -916,7 +1487,8 @@ def SendObject(cnt): # 0x100D
 #  # hdr.p2 0:rw 1:ro
 #  in_hdr_ok()
 
-def CloseSession(cnt): # 0x1007
+def CloseSession(cnt): # 0x1003
+  oh_save()
   in_hdr_ok()
 
 # callback functions for opcodes
@@ -933,6 +1505,10 @@ ptp_opcode_cb = {
   0x100B:DeleteObject,
   0x100C:SendObjectInfo,
   0x100D:SendObject,
+  0x9801:GetObjectPropsSupported,
+  0x9802:GetObjectPropDesc,
+  0x9803:GetObjectPropValue,
+  0x9805:GetObjectPropList,
   #0x1012:SetObjectProtection,
 }
 
@@ -1019,24 +1595,31 @@ def out_fpga(xferred_bytes:int):
     #print_hexdump(hashlib.md5(ptp_buf[:xferred_bytes]).digest())
   out_end(xferred_bytes,0,len(ptp_buf))
 
+# USB OUT packets of any length go to flash ring.
+# next OUT is submitted before flashing so host sends
+# while sector is erased and programmed. ring has
+# less than 4096 bytes left after ring_flash(),
+# OUT of up to 4096 bytes always fits
 def out_flash(xferred_bytes:int):
-  global remaining_send_length,addr
+  global remaining_send_length
+  if remaining_send_length>0:
+    ring_write(memoryview(ptp_buf)[:min(xferred_bytes,remaining_send_length)])
+  remaining_send_length-=xferred_bytes
   if remaining_send_length>0:
-    if xferred_bytes<4096:
-      memoryview(ptp_buf)[52+xferred_bytes:4148]=bytearray(b"\xff"*(4096-xferred_bytes))
-    ecp5.flash_write_block_retry(memoryview(ptp_buf)[:4096],addr&0xFFF000)
-    memoryview(ptp_buf)[:52]=ptp_buf[4096:4148]
-    addr+=xferred_bytes
-  out_end(xferred_bytes,52,4148)
+    usbd.submit_xfer(PTP_DATA_OUT,memoryview(ptp_buf)[:4096])
+    ring_flash(False)
+  else:
+    ep_cb[PTP_DATA_OUT]=out_cmd
+    ok=close_sendobject()
+    in_end_sendobject(ok)
 
 def in_empty(xferred_bytes):
   usbd.submit_xfer(PTP_DATA_OUT,ptp_buf)
 
-def in_ok(xferred_bytes):
-  ep_cb[PTP_DATA_IN]=in_empty
-  in_hdr_ok()
+def in_data_next(xferred_bytes):
+  in_data_fill(0)
 
-def in_end_getobject(xferred_bytes):
+def in_end_data(xferred_bytes):
   hdr_ok()
   hdr.txid=txid
   ep_cb[PTP_DATA_IN]=in_empty
@@ -1049,21 +1632,21 @@ def in_get_file(xferred_bytes):
   if remain_getobj_len<=0:
     remain_getobj_len=0
     fd.close()
-    ep_cb[PTP_DATA_IN]=in_end_getobject
+    ep_cb[PTP_DATA_IN]=in_end_data
   #print(">",end="")
   #print_hexdump(ptp_buf[:packet_len])
   usbd.submit_xfer(PTP_DATA_IN,memoryview(ptp_buf)[:packet_len])
 
 def in_get_flash(xferred_bytes):
-  global remain_getobj_len,addr
-  ecp5.flash_read_block(memoryview(ptp_buf)[:4096],addr)
-  addr+=4096
-  remain_getobj_len-=4096
+  global remain_getobj_len
+  packet_len=flash_reader.readinto(memoryview(ptp_buf)[:4096])
+  remain_getobj_len-=packet_len
   if remain_getobj_len<=0:
     remain_getobj_len=0
+    flash_reader.close()
     ecp5.flash_close()
-    ep_cb[PTP_DATA_IN]=in_end_getobject
-  usbd.submit_xfer(PTP_DATA_IN,memoryview(ptp_buf)[:4096])
+    ep_cb[PTP_DATA_IN]=in_end_data
+  usbd.submit_xfer(PTP_DATA_IN,memoryview(ptp_buf)[:packet_len])
 
 # not used
 def ptp_event_in_done(xferred_bytes):
@@ -1081,6 +1664,9 @@ ep_cb = {
 def _xfer_cb(ep_addr,result,xferred_bytes):
   ep_cb[ep_addr](xferred_bytes)
 
+# handles of previous sessions
+oh_load()
+
 # Switch the USB device to our custom USB driver.
 usbd=machine.USBDevice()
 usbd.builtin_driver=usbd.BUILTIN_CDC
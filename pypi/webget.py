@@ -0,0 +1 @@
+../webget.py
\ No newline at end of file
@@ -18,7 +18,7 @@ class sdraw:
   
   def stopwatch_stop(self, bytes_uploaded):
     elapsed_ms = ticks_ms() - self.stopwatch_ms
-    transfer_rate_MBps = 0
+    transfer_rate_kBps = 0
     if elapsed_ms > 0:
       transfer_rate_kBps = bytes_uploaded // elapsed_ms
     print("%d bytes uploaded in %d ms (%d kB/s)" % (bytes_uploaded, elapsed_ms, transfer_rate_kBps))
@@ -31,20 +31,9 @@ class sdraw:
     return filedata
 
   def open_web(self, url, gz=False):
-    import socket
-    _, _, host, path = url.split('/', 3)
-    port = 80
-    if ( len(host.split(':')) == 2 ):
-      host, port = host.split(':', 2)
-    print("host = ",host," port = ", port, " path = ", path)
-    addr = socket.getaddrinfo(host, port)[0][-1]
-    s = socket.socket()
-    s.connect(addr)
-    s.send(bytes('GET /%s HTTP/1.0\r\nHost: %s\r\nAccept:  image/*\r\n\r\n' % (path, host), 'utf8'))
-    for i in range(100): # read first 100 lines searching for
-      if len(s.readline()) < 3: # first empty line (contains "\r\n")
-        break
-    if gz:
+    import webget
+    s = webget.get(url)
+    if gz and s:
       import uzlib
       return uzlib.DecompIO(s,31)
     return s
@@ -82,6 +71,40 @@ class sdraw:
     self.sd_close()
     return True
 
+  # h: object with update(), e.g. hashlib.sha256()
+  def sd_hash(self, h, addr=0, length=512, blocksize=16384):
+    return self.sd_read_stream(h, addr, length, blocksize)
+
+  # read SD to sink: object with write() (file, socket)
+  # or update() (hash), reusing one buffer of blocksize
+  def sd_read_stream(self, sink, addr=0, length=512, blocksize=16384):
+    if not self.sd_check_param(addr):
+      return False
+    if hasattr(sink, "update"):
+      out = sink.update
+    else:
+      out = sink.write
+    self.sd_open()
+    addr = self.sd_wrapaddr(addr)
+    self.stopwatch_start()
+    block = bytearray(blocksize)
+    mv = memoryview(block)
+    done = 0
+    while done < length:
+      n = min(blocksize, (length-done+0x1FF) & ~0x1FF)
+      self.sd.readblocks((addr+done)//0x200, mv[:n])
+      out(mv[:min(n, length-done)])
+      done += n
+    self.stopwatch_stop(length)
+    self.sd_close()
+    return True
+
+  def sd_size(self):
+    self.sd_open()
+    size = self.sd.ioctl(4,0)*0x200
+    self.sd_close()
+    return size
+
   def sd_write_stream(self, filedata, addr=0, blocksize=16384):
     if not self.sd_check_param(addr):
       return False
@@ -95,10 +118,21 @@ class sdraw:
       waddr=addr+bytes_uploaded
       if waddr >= nearend and len(block) > 0x200:
         block = bytearray(0x200)
-      if filedata.readinto(block):
-        self.sd.writeblocks(waddr//0x200,block)
-        bytes_uploaded += len(block)
-      else:
+      # socket or decompressor may return less than block
+      n = 0
+      while n < len(block):
+        r = filedata.readinto(memoryview(block)[n:])
+        if not r:
+          break
+        n += r
+      if n:
+        if n < len(block): # last block, pad to 512
+          for i in range(n, len(block)):
+            block[i] = 0
+          n = (n+0x1FF) & ~0x1FF
+        self.sd.writeblocks(waddr//0x200,memoryview(block)[:n])
+        bytes_uploaded += n
+      if n < len(block):
         break
     self.stopwatch_stop(bytes_uploaded)
     self.sd_close()
@@ -111,17 +145,37 @@ def read(addr=0, length=512):
   else:
     return False
 
+# card size in bytes
+def size():
+  return sdraw().sd_size()
+
+# algo: "crc32" or hashlib name "sha256", "sha1", "md5"
+# returns hex string
+def hash(addr=0, length=512, algo="sha256"):
+  from binascii import hexlify
+  from hashsum import hash_new
+  h = hash_new(algo)
+  if sdraw().sd_hash(h, addr, length):
+    return hexlify(h.digest()).decode()
+  else:
+    return False
+
 def write(filepath, addr=0):
   gz=filepath.endswith(".gz")
+  # raw stream is closed, web: keep-alive socket back to pool
   if filepath.startswith("http://") or filepath.startswith("/http:/"):
-    filedata = sdraw().open_web(filepath, gz)
+    raw = sdraw().open_web(filepath)
   else:
-    filedata = sdraw().open_file(filepath, gz)
-  if filedata:
-    if gz:
-      return sdraw().sd_write_stream(filedata,addr,blocksize=4096)
-    else:
-      return sdraw().sd_write_stream(filedata,addr,blocksize=16384)
+    raw = sdraw().open_file(filepath)
+  if raw:
+    try:
+      if gz:
+        import uzlib
+        return sdraw().sd_write_stream(uzlib.DecompIO(raw,31),addr,blocksize=4096)
+      else:
+        return sdraw().sd_write_stream(raw,addr,blocksize=16384)
+    finally:
+      raw.close()
   return False
 
 def help():
@@ -129,3 +183,4 @@ def help():
   print("sdraw.write(\"http://192.168.4.2/sdcard.img\", addr=0) # to start of SD")
   print("sdraw.read(addr=0, length=512) # from start of SD")
   print("sdraw.read(-1024) # from 1024 bytes before end of SD")
+  print("sdraw.hash(addr=0, length=0x100000, algo=\"sha256\") # or \"crc32\"")
@@ -0,0 +1,92 @@
+# benchmark ecp5.py against the simulated board
+#
+# usage (from repository root):
+# python3 sim/bench.py [size_kB] [--save ref.json] [--compare ref.json]
+# micropython sim/bench.py [size_kB]
+#
+# "--compare" exits with 1 if any operation became
+# more than 10% slower in virtual time than in reference.
+
+import sys, io
+sys.path.insert(0, (sys.path[0] or ".") + "/..")
+import ecp5sim
+board = ecp5sim.install()
+import ecp5
+
+# deterministic pseudo-random bitstream with ECP5 preamble
+def bitstream(size, seed=12345):
+  img = bytearray(size)
+  img[0:16] = b"\xFF\x00Lattice\x00\x00\x00\x00\x00\x00\x00"
+  img[16:20] = b"\xFF\xFF\xBD\xB3"
+  x = seed
+  for i in range(20, size):
+    x = (x * 1103515245 + 12345) & 0x7FFFFFFF
+    img[i] = (x >> 16) & 0xFF
+  return img
+
+results = {}
+
+# run fn(), print and collect virtual time and counters
+def measure(name, nbytes, fn):
+  board.clear_stats()
+  t0 = board.now_ns
+  ret = fn()
+  ms = (board.now_ns - t0) // 1000000
+  kBps = nbytes // ms if ms else 0
+  print("== %s: %s, %d bytes in %d virtual ms (%d kB/s)" % (name, ret, nbytes, ms, kBps))
+  board.report()
+  results[name] = ms
+  return ret
+
+def prog(img):
+  ecp5.prog_stream(io.BytesIO(img))
+  return ecp5.prog_close()
+
+def flash(img, addr):
+  ok = ecp5.flash_stream(io.BytesIO(img), addr)
+  ecp5.flash_close()
+  return ok
+
+def main():
+  size = 256
+  save = compare = None
+  args = sys.argv[1:]
+  while args:
+    a = args.pop(0)
+    if a == "--save":
+      save = args.pop(0)
+    elif a == "--compare":
+      compare = args.pop(0)
+    else:
+      size = int(a)
+  img = bitstream(size * 1024)
+  print("IDCODE 0x%08X" % ecp5.idcode())
+  measure("prog", len(img), lambda: prog(img))
+  measure("flash blank", len(img), lambda: flash(img, 0x200000))
+  measure("flash same", len(img), lambda: flash(img, 0x200000))
+  img[-100:] = b"\x55" * 100 # small config change at the end
+  measure("flash tail change", len(img), lambda: flash(img, 0x200000))
+  img[-4:] = b"\x00" * 4 # only clears bits, no erase
+  measure("flash tail bits", len(img), lambda: flash(img, 0x200000))
+  img = bitstream(size * 1024, 54321)
+  measure("flash other", len(img), lambda: flash(img, 0x200000))
+  if board.flash.mem[0x200000:0x200000 + len(img)] != img:
+    print("FAIL flash content differs from image")
+    sys.exit(1)
+  if save:
+    import json
+    with open(save, "w") as f:
+      json.dump(results, f)
+  if compare:
+    import json
+    with open(compare) as f:
+      ref = json.load(f)
+    slower = 0
+    for name in ref:
+      if name in results and results[name] > ref[name] * 11 // 10:
+        print("REGRESSION %s: %d ms, reference %d ms" % (name, results[name], ref[name]))
+        slower += 1
+    if slower:
+      sys.exit(1)
+
+main()
@@ -0,0 +1,729 @@
+# host-side simulated ECP5 JTAG + SPI FLASH + SD
+# runs ecp5.py, ecp5wp.py, sdraw.py and rbp/ drivers
+# under CPython or unix micropython
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+# usage:
+# import ecp5sim
+# ecp5sim.install()
+# import ecp5
+# ecp5.prog("blink.bit")
+# ecp5sim.board.report()
+
+# The simulated board supplies "machine" (Pin, SPI, SoftSPI, SDCard),
+# "jtagpin" and "sdpin" and a "time" with virtual ticks_ms() and
+# sleep_ms(). Under CPython also "micropython", "uctypes" and ptr8.
+#
+# Time is virtual: it advances only by modelled TCK cycles,
+# SPI transfers, FLASH busy (WIP) periods and sleep_ms(),
+# so kB/s printed by the drivers approximate ESP32
+# at 20 MHz JTAG clock, without host CPU load noise.
+# CPU time of gzip decompression or viper compare
+# loops is not modelled.
+
+import sys, _thread
+main_thread=_thread.get_ident()
+
+# ULX3S v3.1.x pinout, same as rbp/ drivers
+PIN_TMS = 5
+PIN_TCK = 18
+PIN_TDI = 23
+PIN_TDO = 34
+PIN_TCKNC = 21
+PIN_LED = 19
+
+# modelled ESP32 costs, adjust to calibrate
+BITBANG_TCK_NS = 1000 # viper bitbang one TCK cycle
+SOFTSPI_BIT_NS = 2000 # SoftSPI one bit
+SPI_CALL_US = 10 # hardware SPI transaction setup
+SPI_INIT_US = 30 # hardware SPI init() pin remap
+SD_BLOCK_US = 500 # SD card 512-byte block
+
+# FLASH typical latencies (W25Q128JV datasheet)
+FLASH_PP_US = 400 # page program
+FLASH_SE_US = { 4096:45000, 32768:120000, 65536:150000 } # sector/block erase
+FLASH_CE_US = 40000000 # chip erase
+FLASH_WRSR_US = 10000 # write status register
+
+# TAP states
+TLR,IDLE,SELDR,CAPDR,SHDR,EX1DR,PADR,EX2DR,UPDR,SELIR,CAPIR,SHIR,EX1IR,PAIR,EX2IR,UPIR=range(16)
+# next state for tms=0 and tms=1
+TAP_NEXT=(
+(IDLE,TLR),    # TLR
+(IDLE,SELDR),  # IDLE
+(CAPDR,SELIR), # SELDR
+(SHDR,EX1DR),  # CAPDR
+(SHDR,EX1DR),  # SHDR
+(PADR,UPDR),   # EX1DR
+(PADR,EX2DR),  # PADR
+(SHDR,UPDR),   # EX2DR
+(IDLE,SELDR),  # UPDR
+(CAPIR,TLR),   # SELIR
+(SHIR,EX1IR),  # CAPIR
+(SHIR,EX1IR),  # SHIR
+(PAIR,UPIR),   # EX1IR
+(PAIR,EX2IR),  # PAIR
+(SHIR,UPIR),   # EX2IR
+(IDLE,SELDR),  # UPIR
+)
+
+# ECP5 instructions
+ISC_ENABLE=0xC6
+ISC_DISABLE=0x26
+ISC_ERASE=0x0E
+LSC_PRELOAD=0x1C
+LSC_INIT_ADDRESS=0x46
+LSC_BITSTREAM_BURST=0x7A
+LSC_READ_STATUS=0x3C
+LSC_PROG_SPI=0x3A
+LSC_REFRESH=0x79
+READ_ID=0xE0
+USERCODE=0xC0
+BYPASS=0xFF
+
+# LSC_READ_STATUS bits
+STATUS_DONE=0x100
+STATUS_ISC=0x200
+STATUS_FAIL=0x2000
+
+# ECP5 bitstream preamble
+PREAMBLE=0xFFFFBDB3
+
+class SPIFlash:
+  def __init__(self, board, size=1<<24, jedec=None, uid=b"\xD1\x5E\xA5\xE0\x12\x34\x56\x78"):
+    self.board=board
+    self.size=size
+    self.mem=bytearray(b"\xFF")*size
+    self.jedec=bytes(jedec or b"\xEF\x40"+bytes([size.bit_length()-1])) # capacity 2^n
+    self.uid=bytes(uid)
+    self.sr=bytearray(3) # status registers 1-3
+    self.fr=0 # ISSI function register
+    self.wel=0
+    self.busy_until=0
+    self.selected=False
+    self.stats={}
+    self.select()
+    self.selected=False
+
+  def count(self, key, n=1):
+    self.stats[key]=self.stats.get(key,0)+n
+
+  def busy(self):
+    return self.board.now_ns<self.busy_until
+
+  def set_busy(self, us):
+    self.busy_until=self.board.now_ns+us*1000
+    self.count("busy_us",us)
+
+  def status1(self):
+    return (self.sr[0]&0xFC)|(self.wel<<1)|(1 if self.busy() else 0)
+
+  def select(self):
+    self.selected=True
+    self.cmd=-1
+    self.nin=0 # bytes received in this CS cycle
+    self.arg=bytearray()
+    self.addr=0
+    self.out=0xFF # MISO byte for current byte slot
+    self.bitpos=0
+    self.bit_in=0
+    self.bit_out=0xFF
+    self.page=None
+
+  # one byte clocked in both directions
+  # returns MISO byte for this slot
+  def byte(self, b):
+    ret=self.out
+    n=self.nin
+    self.nin+=1
+    if n==0:
+      self.cmd=b
+      self.count("cmd_%02X" % b)
+      if self.busy() and b not in (0x05,0x35,0x15):
+        self.count("ignored_busy")
+        self.cmd=-2
+      self.out=0xFF
+    cmd=self.cmd
+    if n>0:
+      if cmd in (0x03,0x0B,0x02,0x20,0x52,0xD8,0x90) and n<4:
+        self.addr=(self.addr<<8)|b
+      elif cmd==0x02:
+        self.page_byte(b)
+      elif cmd in (0x01,0x31,0x11,0x42):
+        self.arg.append(b)
+    # prepare MISO for next slot
+    if cmd==0x05:
+      self.out=self.status1()
+      if n>0:
+        self.count("status_polls")
+    elif cmd==0x35:
+      self.out=self.sr[1]
+    elif cmd==0x15:
+      self.out=self.sr[2]
+    elif cmd==0x48:
+      self.out=self.fr
+    elif cmd==0x9F:
+      self.out=self.jedec[n] if n<3 else 0xFF
+    elif cmd==0x4B:
+      self.out=self.uid[(n-4)&7] if n>=4 else 0xFF
+    elif cmd==0x90:
+      self.out=(self.jedec[0],self.jedec[2]-1)[(n-3)&1] if n>=3 else 0xFF
+    elif cmd==0x03 and n>=3:
+      self.out=self.mem[self.addr%self.size]
+      self.addr+=1
+      self.count("read_bytes")
+    elif cmd==0x0B and n>=4:
+      self.out=self.mem[self.addr%self.size]
+      self.addr+=1
+      self.count("read_bytes")
+    return ret
+
+  # bulk READ data phase, fills buf without per-byte calls
+  def can_bulk_read(self):
+    return self.bitpos==0 and ((self.cmd==0x03 and self.nin>=4) or (self.cmd==0x0B and self.nin>=5))
+
+  def bulk_read(self, buf):
+    n=len(buf)
+    a=(self.addr-1)%self.size # self.out already holds mem[addr-1]
+    if a+n<=self.size:
+      buf[:]=self.mem[a:a+n]
+    else:
+      for i in range(n):
+        buf[i]=self.mem[(a+i)%self.size]
+    self.addr=a+n+1
+    self.out=self.mem[(a+n)%self.size]
+    self.nin+=n
+    self.count("read_bytes",n)
+
+  def page_byte(self, b):
+    if self.page is None:
+      self.page=bytearray(b"\xFF")*256
+      self.page_base=self.addr&~0xFF
+      self.page_ofs=self.addr&0xFF
+      self.page_n=0
+    self.page[self.page_ofs]&=b
+    self.page_ofs=(self.page_ofs+1)&0xFF
+    self.page_n+=1
+
+  def bulk_page(self, buf):
+    for b in buf:
+      self.page_byte(b)
+    self.nin+=len(buf)
+
+  # bit-level access for bitbanging, MSB first
+  def bit(self, mosi):
+    if self.bitpos==0:
+      self.bit_out=self.out
+    miso=(self.bit_out>>(7-self.bitpos))&1
+    self.bit_in=(self.bit_in<<1)|(mosi&1)
+    self.bitpos+=1
+    if self.bitpos==8:
+      self.bitpos=0
+      self.byte(self.bit_in&0xFF)
+      self.bit_in=0
+    return miso
+
+  # CS rising edge executes write commands
+  def deselect(self):
+    if not self.selected:
+      return
+    self.selected=False
+    cmd=self.cmd
+    if cmd<0 or self.bitpos: # CS high at incomplete byte
+      return
+    if cmd==0x06:
+      self.wel=1
+    elif cmd==0x04:
+      self.wel=0
+    elif cmd==0x02 and self.wel and self.page is not None:
+      base=self.page_base%self.size
+      mem=self.mem
+      page=self.page
+      for i in range(256):
+        mem[base+i]&=page[i]
+      self.count("pages_programmed")
+      self.count("bytes_programmed",self.page_n)
+      self.set_busy(FLASH_PP_US)
+      self.wel=0
+    elif cmd in (0x20,0x52,0xD8) and self.wel and self.nin>=4:
+      size={0x20:4096,0x52:32768,0xD8:65536}[cmd]
+      a=(self.addr%self.size)&~(size-1)
+      self.mem[a:a+size]=b"\xFF"*size
+      self.count("erase_%dK" % (size>>10))
+      self.set_busy(FLASH_SE_US[size])
+      self.wel=0
+    elif cmd in (0xC7,0x60) and self.wel:
+      self.mem[:]=b"\xFF"*self.size
+      self.count("erase_chip")
+      self.set_busy(FLASH_CE_US)
+      self.wel=0
+    elif cmd in (0x01,0x31,0x11,0x42) and self.wel and len(self.arg):
+      if cmd==0x01:
+        self.sr[0]=self.arg[0]&0xFC
+        if len(self.arg)>1:
+          self.sr[1]=self.arg[1]
+      elif cmd==0x31:
+        self.sr[1]=self.arg[0]
+      elif cmd==0x11:
+        self.sr[2]=self.arg[0]
+      else:
+        self.fr|=self.arg[0] # OTP bits can't be reset
+      self.set_busy(FLASH_WRSR_US)
+      self.wel=0
+
+class SDCard:
+  def __init__(self, board, blocks=1<<17):
+    self.board=board
+    self.blocks=blocks # 64MB default
+    self.data={} # sparse 512-byte blocks
+    self.stats={}
+
+  def count(self, key, n=1):
+    self.stats[key]=self.stats.get(key,0)+n
+
+  def readblocks(self, block_num, buf, offset=0):
+    mv=memoryview(buf)
+    n=len(mv)
+    for i in range(0,n,512):
+      blk=self.data.get(block_num+(offset+i)//512)
+      mv[i:i+512]=blk if blk else b"\x00"*min(512,n-i)
+    self.board.advance_us(SD_BLOCK_US*((n+511)//512))
+    self.count("read_bytes",n)
+
+  def writeblocks(self, block_num, buf, offset=0):
+    mv=memoryview(buf)
+    n=len(mv)
+    for i in range(0,n,512):
+      self.data[block_num+(offset+i)//512]=bytes(mv[i:i+512])
+    self.board.advance_us(SD_BLOCK_US*((n+511)//512))
+    self.count("write_bytes",n)
+
+  def ioctl(self, op, arg):
+    if op==4: # block count
+      return self.blocks
+    if op==5: # block size
+      return 512
+    return 0
+
+class Board:
+  def __init__(self, idcode=0x21111043, flash_size=1<<24):
+    self.now_ns=0
+    self.idcode=idcode
+    self.level={}
+    self.tdo=0
+    self.flash=SPIFlash(self,flash_size)
+    self.sd=SDCard(self)
+    self.stats={}
+    self.reset_tap()
+    self.status=0
+    self.state=TLR
+
+  def count(self, key, n=1):
+    self.stats[key]=self.stats.get(key,0)+n
+
+  def advance_us(self, us):
+    self.now_ns+=us*1000
+
+  def reset_tap(self):
+    self.state=TLR
+    self.ir=READ_ID
+    self.spi_mode=False
+    self.ir_sr=0
+    self.dr_sr=0
+    self.dr_len=0
+    self.dr_bits=0
+
+  # ---- bitstream engine ----
+  def burst_start(self):
+    self.bs_sr=0
+    self.bs_synced=False
+    self.bs_bytes=0
+
+  def burst_bit(self, b):
+    if self.bs_synced:
+      self.bs_bits+=1
+      if self.bs_bits==8:
+        self.bs_bits=0
+        self.bs_bytes+=1
+    else:
+      self.bs_sr=((self.bs_sr<<1)|b)&0xFFFFFFFF
+      if self.bs_sr==PREAMBLE:
+        self.bs_synced=True
+        self.bs_bits=0
+
+  def burst_bytes(self, buf):
+    if self.bs_synced:
+      self.bs_bytes+=len(buf)
+      return
+    for i in range(len(buf)):
+      v=buf[i]
+      for j in range(8):
+        self.burst_bit((v>>(7-j))&1)
+      if self.bs_synced:
+        self.bs_bytes+=len(buf)-i-1
+        return
+
+  # ---- TAP ----
+  def capture_dr(self):
+    ir=self.ir
+    self.dr_bits=0
+    if ir==READ_ID:
+      self.dr_sr,self.dr_len=self.idcode,32
+    elif ir==LSC_READ_STATUS:
+      self.dr_sr,self.dr_len=self.status,32
+    elif ir==USERCODE:
+      self.dr_sr,self.dr_len=0,32
+    elif ir==LSC_PROG_SPI and self.spi_mode:
+      self.flash.select()
+      self.dr_sr,self.dr_len=0,0
+    elif ir==LSC_PROG_SPI:
+      self.dr_sr,self.dr_len=0,16
+    elif ir==LSC_BITSTREAM_BURST:
+      self.dr_sr,self.dr_len=0,0
+    else:
+      self.dr_sr,self.dr_len=0,1
+
+  def update_dr(self):
+    ir=self.ir
+    if ir==ISC_ENABLE:
+      self.status|=STATUS_ISC
+    elif ir==ISC_ERASE:
+      self.status&=~(STATUS_DONE|STATUS_FAIL)
+      self.count("sram_erase")
+    elif ir==LSC_INIT_ADDRESS:
+      self.burst_start()
+    elif ir==LSC_PROG_SPI and not self.spi_mode:
+      if (self.dr_sr&0xFFFF)==0x68FE:
+        self.spi_mode=True
+    elif ir==LSC_REFRESH:
+      self.count("refresh")
+      self.status&=~STATUS_ISC
+      if self.flash.mem.find(b"\xFF\xFF\xBD\xB3",0,4096)>=0:
+        self.status|=STATUS_DONE
+      else:
+        self.status&=~STATUS_DONE
+
+  def update_ir(self):
+    ir=self.ir_sr&0xFF
+    self.ir=ir
+    self.spi_mode=False
+    self.count("ir_%02X" % ir)
+    if ir==LSC_BITSTREAM_BURST:
+      if not hasattr(self,"bs_sr"):
+        self.burst_start()
+    elif ir==ISC_DISABLE:
+      if getattr(self,"bs_synced",False):
+        self.status|=STATUS_DONE
+        self.status&=~STATUS_FAIL
+        self.count("bitstream_bytes",self.bs_bytes)
+        self.bs_synced=False
+      self.status&=~STATUS_ISC
+
+  def shift_dr_bit(self, tdi):
+    if self.ir==LSC_PROG_SPI and self.spi_mode:
+      return self.flash.bit(tdi)
+    if self.ir==LSC_BITSTREAM_BURST:
+      self.burst_bit(tdi)
+      return 0
+    out=self.dr_sr&1
+    if self.dr_len:
+      self.dr_sr=(self.dr_sr>>1)|(tdi<<(self.dr_len-1))
+    self.dr_bits+=1
+    return out
+
+  # TCK rising edge
+  def tck_edge(self, tms, tdi):
+    st=self.state
+    self.count("tck")
+    if st==SHDR:
+      self.tdo=self.shift_dr_bit(tdi)
+    elif st==SHIR:
+      self.tdo=self.ir_sr&1
+      self.ir_sr=(self.ir_sr>>1)|(tdi<<7)
+    new=TAP_NEXT[st][tms]
+    if st==SHDR and new!=SHDR and self.ir==LSC_PROG_SPI and self.spi_mode:
+      self.flash.deselect()
+    if new!=st:
+      if new==TLR:
+        self.reset_tap()
+      elif new==CAPDR:
+        self.capture_dr()
+      elif new==UPDR:
+        self.update_dr()
+      elif new==CAPIR:
+        self.ir_sr=0x01
+      elif new==UPIR:
+        self.update_ir()
+    self.state=new
+
+  # ---- SPI byte transfers while TCK is driven by SPI ----
+  # tms is held, tdi/tdo carry MSB first bits
+  def spi_transfer(self, wbuf, rbuf, n, fill):
+    self.count("tck",8*n)
+    tms=self.level.get(PIN_TMS,0)
+    flash=self.flash
+    if self.state==SHDR and tms==0:
+      if self.ir==LSC_PROG_SPI and self.spi_mode:
+        if rbuf is not None and wbuf is None and flash.can_bulk_read():
+          flash.bulk_read(rbuf)
+          self.count("tck_spi_flash",8*n)
+          return
+        if rbuf is None and flash.cmd==0x02 and flash.nin>=4 and flash.bitpos==0:
+          flash.bulk_page(wbuf)
+          self.count("tck_spi_flash",8*n)
+          return
+        self.count("tck_spi_flash",8*n)
+        for i in range(n):
+          w=wbuf[i] if wbuf is not None else fill
+          if flash.bitpos==0:
+            r=flash.byte(w)
+          else:
+            r=0
+            for j in range(8):
+              r=(r<<1)|flash.bit((w>>(7-j))&1)
+          if rbuf is not None:
+            rbuf[i]=r
+        return
+      if self.ir==LSC_BITSTREAM_BURST and wbuf is not None:
+        self.count("tck_spi_burst",8*n)
+        self.burst_bytes(wbuf if len(wbuf)==n else wbuf[:n])
+        return
+    # generic: clock each bit through TAP
+    self.count("tck",-8*n)
+    for i in range(n):
+      w=wbuf[i] if wbuf is not None else fill
+      r=0
+      for j in range(8):
+        self.tck_edge(tms,(w>>(7-j))&1)
+        r=(r<<1)|self.tdo
+      if rbuf is not None:
+        rbuf[i]=r
+
+  def report(self):
+    print("virtual time %d ms" % (self.now_ns//1000000))
+    for name,stats in (("jtag",self.stats),("flash",self.flash.stats),("sd",self.sd.stats)):
+      for k in sorted(stats):
+        print("%-5s %-20s %d" % (name,k,stats[k]))
+
+  def clear_stats(self):
+    self.stats={}
+    self.flash.stats={}
+    self.sd.stats={}
+
+board=None
+
+# ---- machine ----
+class Pin:
+  IN=1
+  OUT=3
+  OPEN_DRAIN=7
+  PULL_UP=2
+  PULL_DOWN=1
+
+  def __init__(self, id, mode=-1, pull=-1, value=None):
+    self.id=id
+    if value is not None:
+      self.value(value)
+
+  def init(self, mode=-1, pull=-1, value=None):
+    if value is not None:
+      self.value(value)
+
+  def value(self, v=None):
+    if v is None:
+      if self.id==PIN_TDO:
+        return board.tdo
+      return board.level.get(self.id,0)
+    v=1 if v else 0
+    if self.id==PIN_TCK:
+      prev=board.level.get(PIN_TCK,0)
+      board.level[PIN_TCK]=v
+      if v and not prev:
+        board.now_ns+=BITBANG_TCK_NS
+        board.count("tck_bitbang")
+        board.tck_edge(board.level.get(PIN_TMS,0),board.level.get(PIN_TDI,0))
+    else:
+      board.level[self.id]=v
+
+  def on(self):
+    self.value(1)
+
+  def off(self):
+    self.value(0)
+
+  def __call__(self, v=None):
+    return self.value(v)
+
+class SPI:
+  MSB=0
+  LSB=1
+
+  def __init__(self, id=1, baudrate=1000000, polarity=0, phase=0, bits=8, firstbit=0, sck=None, mosi=None, miso=None):
+    self.soft=(id==-1)
+    self.baudrate=baudrate
+    self.sck=sck.id if sck else None
+
+  def init(self, baudrate=None, polarity=0, phase=0, bits=8, firstbit=0, sck=None, mosi=None, miso=None):
+    if baudrate:
+      self.baudrate=baudrate
+    if sck is not None:
+      board.now_ns+=SPI_INIT_US*1000
+      if sck.id==PIN_TCK and self.sck!=PIN_TCK:
+        # the TCK glitch of switching from bitbanging to SPI
+        board.count("tck_glitch")
+        board.tck_edge(board.level.get(PIN_TMS,0),board.level.get(PIN_TDI,0))
+        board.level[PIN_TCK]=1
+      self.sck=sck.id
+
+  def deinit(self):
+    pass
+
+  def xfer(self, wbuf, rbuf, n, fill=0):
+    if self.soft:
+      board.now_ns+=SOFTSPI_BIT_NS*8*n
+      board.count("tck_softspi",8*n)
+    else:
+      board.now_ns+=SPI_CALL_US*1000+8*n*1000000000//self.baudrate
+      board.count("tck_hwspi",8*n)
+    if self.sck==PIN_TCK:
+      board.spi_transfer(wbuf,rbuf,n,fill)
+      board.level[PIN_TCK]=1
+      if wbuf is not None and n:
+        board.level[PIN_TDI]=wbuf[n-1]&1
+    elif rbuf is not None:
+      for i in range(n):
+        rbuf[i]=0xFF if board.tdo else 0
+
+  def write(self, buf):
+    self.xfer(buf,None,len(buf))
+
+  def readinto(self, buf, write=0):
+    self.xfer(None,buf,len(buf),write)
+
+  def read(self, n, write=0):
+    buf=bytearray(n)
+    self.xfer(None,buf,n,write)
+    return bytes(buf)
+
+  def write_readinto(self, wbuf, rbuf):
+    self.xfer(wbuf,rbuf,len(wbuf))
+
+class SoftSPI(SPI):
+  def __init__(self, baudrate=500000, polarity=0, phase=0, bits=8, firstbit=0, sck=None, mosi=None, miso=None):
+    SPI.__init__(self,-1,baudrate,polarity,phase,bits,firstbit,sck,mosi,miso)
+
+class SimSDCard:
+  def __init__(self, slot=1, *args, **kwargs):
+    self.card=board.sd
+
+  def readblocks(self, block_num, buf, offset=0):
+    self.card.readblocks(block_num,buf,offset)
+
+  def writeblocks(self, block_num, buf, offset=0):
+    self.card.writeblocks(block_num,buf,offset)
+
+  def ioctl(self, op, arg):
+    return self.card.ioctl(op,arg)
+
+  def deinit(self):
+    pass
+
+class Namespace:
+  def __init__(self, **kw):
+    for k in kw:
+      setattr(self,k,kw[k])
+
+def _freq(hz=None):
+  if hz is None:
+    return 240000000
+
+def _ticks_ms():
+  return board.now_ns//1000000
+
+def _ticks_us():
+  return board.now_ns//1000
+
+# only main thread advances virtual time,
+# other threads (pipeline reader) sleep real time
+def _sleep_ms(ms):
+  if _thread.get_ident()!=main_thread:
+    _real_sleep(0.0001)
+    return
+  board.now_ns+=int(ms)*1000000
+  _real_sleep(0) # let reader thread run
+
+def _sleep_us(us):
+  board.now_ns+=int(us)*1000
+
+def _sleep(s):
+  board.now_ns+=int(s*1000000000)
+
+# viper pointer emulation for CPython
+class Ptr8:
+  def __init__(self, obj):
+    self.mv=memoryview(obj).cast("B") if not isinstance(obj,memoryview) or obj.format!="B" else obj
+
+  def __getitem__(self, i):
+    return self.mv[i]
+
+  def __setitem__(self, i, v):
+    self.mv[i]=v&0xFF
+
+class Addr(int):
+  def __new__(cls, obj):
+    a=int.__new__(cls,id(obj))
+    a.ptr=Ptr8(obj)
+    return a
+
+  def __getitem__(self, i):
+    return self.ptr[i]
+
+  def __setitem__(self, i, v):
+    self.ptr[i]=v
+
+def _ptr8(a):
+  if isinstance(a,Addr):
+    return a.ptr
+  return Ptr8(a)
+
+# install simulated board modules
+# call before importing ecp5 or other drivers
+def install(idcode=0x21111043, flash_size=1<<24):
+  global board
+  board=Board(idcode,flash_size)
+  sys.modules["machine"]=Namespace(Pin=Pin, SPI=SPI, SoftSPI=SoftSPI, SDCard=SimSDCard,
+    freq=_freq, idle=lambda:None, reset=lambda:None)
+  sys.modules["jtagpin"]=Namespace(tms=PIN_TMS, tck=PIN_TCK, tdi=PIN_TDI, tdo=PIN_TDO,
+    tcknc=PIN_TCKNC, led=PIN_LED, flash_hwspi=1)
+  sys.modules["sdpin"]=Namespace(hiz=bytearray([2,4,12,13,14,15]))
+  # virtual time for both CPython and micropython
+  import time
+  if not isinstance(time,Namespace): # not installed before
+    global _real_sleep
+    _real_sleep=time.sleep
+    t=Namespace()
+    for k in dir(time):
+      if not k.startswith("__"):
+        setattr(t,k,getattr(time,k))
+    t.ticks_ms=_ticks_ms
+    t.ticks_us=_ticks_us
+    t.ticks_diff=lambda a,b:a-b
+    t.ticks_add=lambda a,b:a+b
+    t.sleep_ms=_sleep_ms
+    t.sleep_us=_sleep_us
+    t.sleep=_sleep
+    sys.modules["time"]=t
+  if sys.implementation.name=="micropython":
+    return board
+  # CPython: emulate micropython builtins and modules
+  import builtins
+  mp=Namespace(const=lambda x:x, viper=lambda f:f, native=lambda f:f,
+    alloc_emergency_exception_buf=lambda n:None, mem_info=lambda *a:None)
+  sys.modules["micropython"]=mp
+  sys.modules["uctypes"]=Namespace(addressof=Addr)
+  builtins.micropython=mp
+  builtins.const=mp.const
+  builtins.ptr8=_ptr8
+  return board
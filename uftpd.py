@@ -2,44 +2,93 @@
 # Small ftp server for ESP8266 Micropython
 # Based on the work of chrisgp - Christopher Popp and pfalcon - Paul Sokolovsky
 #
-# The server accepts passive mode only. It runs in background.
+# The server accepts passive and active mode. It runs in background,
+# asyncio loop in its own thread, one task per client session.
 # Start the server with:
 #
 # import uftpd
-# uftpd.start([port = 21][, verbose = level])
+# uftpd.start([port = 21][, verbose = level][, http = 0])
 #
 # port is the port number (default 21)
+# http is the HTTP port, default 0: no HTTP server
 # verbose controls the level of printed activity messages, values 0, 1, 2
 #
+# Applications running their own asyncio loop in the main thread
+# (dualusbserial.py) must not use start(): micropython has one
+# global asyncio task queue, two loops in two threads run each
+# other's tasks. Such application calls uftpd.stop() before
+# asyncio.run() and serves FTP as a task of its loop:
+#
+# task = uftpd.task([port = 21][, verbose = level])
+# task.cancel() # stops the server
+#
+# Clients are served concurrently. JTAG, FLASH and SD jobs
+# (STOR FPGA/FLASH@/SD@, SITE) run one at a time in a worker
+# thread holding hw_lock, other clients can meanwhile list and
+# transfer files. Files on /sd also wait for hw_lock.
+#
+# HTTP server (off by default, it has no authentication,
+# enable with uftpd.restart(http=80)) programs
+# without FTP login and data connection, timing is in response
+# header "Server-Timing" and body:
+#
+# curl -T blink.bit http://192.168.4.1/fpga
+# curl -T blink.bit.gz -H "Content-Encoding: gzip" http://192.168.4.1/flash/0x200000
+# curl http://192.168.4.1/flash/0x200000-0x2FFFFF > flash.bin
+# curl http://192.168.4.1/sd/0-0x1FF > mbr.bin
+#
 # Copyright (c) 2016 Christopher Popp (initial ftp server framework)
 # Copyright (c) 2016 Paul Sokolovsky (background execution control structure)
 # Copyright (c) 2016 Robert Hammelrath (putting the pieces together and a
 # few extensions)
 # Distributed under MIT License
 #
-import socket, network, os, io
-from gc import collect
-from time import sleep_ms, localtime
+import socket, network, os, io, _thread
+try:
+  import asyncio
+except ImportError:
+  import uasyncio as asyncio
+from gc import collect, mem_free
+from time import sleep_ms, localtime, ticks_ms, ticks_diff
 from micropython import alloc_emergency_exception_buf
 from machine import Pin
 
 # constant definitions
-_CHUNK_SIZE = const(1024)
-_SO_REGISTER_HANDLER = const(20)
+_CHUNK_SIZE = const(1024) # smallest transfer chunk
+_CHUNK_MAX = const(16384)
+_SOCK_BUF = const(5744) # lwIP TCP_SND_BUF if SO_SNDBUF can't be read
+_POOL_MAX = const(2) # idle transfer buffers kept
+_MTU = const(1460) # listing is sent in writes of about this size
+_LIST_CACHE_DIRS = const(4) # directories kept in listing cache
+_LIST_CACHE_MS = const(60000) # entry expires, VFS may change from REPL
 _COMMAND_TIMEOUT = const(300)
 _DATA_TIMEOUT = const(100)
-_DATA_PORT = const(13333)
+_DATA_PORT = const(13333) # first passive data port
+_DATA_PORTS = const(4) # passive ports _DATA_PORT.._DATA_PORT+3
+_PASV_TIMEOUT = const(10000) # ms to wait for passive data connection
+_JOB_POLL = const(20) # ms between checks for worker thread end
+_SITE_RING = const(1024) # bytes of SITE output waiting to be sent
+_HTTP_HEADERS = const(32) # max request header lines
+_THREAD_STACK = const(16384) # server and job threads, ESP32 default ~5K
 
 # Global variables
-ftpsocket = None
-datasocket = None
 client_list = []
+http_list = [] # HTTP connections being served
+data_ports = {} # passive port -> [owner FTP_client or None, ticks_ms]
 verbose_l = 0
-client_busy = False
+run = 0 # 1: serving, 2: stop request, 0: stopped
+hw_lock = None # asyncio.Lock for JTAG/FLASH/SD
+buf_pool = [] # idle transfer buffers
+list_cache = {} # dir -> (ticks_ms, [(name, mode, size, mtime), ...])
+list_order = [] # cached dirs, least recently used first
+flash_chip = 0 # FLASH size in bytes, 0: not read yet
 # Interfaces: (IP-Address (string), IP-Address (integer), Netmask (integer))
 AP_addr = ("0.0.0.0", 0, 0xffffff00)
 STA_addr = ("0.0.0.0", 0, 0xffffff00)
 
+# HASH algorithm names (OPTS HASH) -> hashlib names
+_hash_algo = {"SHA-256":"sha256", "SHA-1":"sha1", "MD5":"md5", "CRC32":"crc32"}
+
 _month_name = ("", "Jan", "Feb", "Mar", "Apr", "May", "Jun",
                "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
 
@@ -90,35 +139,464 @@ def passthru():
   import ecp5
   ecp5.passthru()
 
-# to capture output of exec()
+# SITE flash_hash(0,0x200000)
+def flash_hash(addr=0, length=0x1000000, algo="sha256"):
+  import ecp5
+  print(ecp5.flash_hash(addr, length, algo))
+
+# SITE sd_hash(0,0x100000,"crc32")
+def sd_hash(addr=0, length=512, algo="sha256"):
+  import sdraw
+  print(sdraw.hash(addr, length, algo))
+
+# to capture output of exec() into a ring buffer,
+# server sends complete lines while exec() runs.
+# exec() thread waits when the ring is full,
+# output from other threads is dropped then.
 class DUP(io.IOBase):
-    def __init__(self, s):
-        self.s = s
+    def __init__(self, size=_SITE_RING):
+        self.buf = bytearray(size)
+        self.rd = 0 # total bytes read
+        self.wr = 0 # total bytes written
+        self.dropped = 0
+        self.lock = _thread.allocate_lock()
+        self.thread = _thread.get_ident()
 
     def write(self, data):
-        self.s += data
+        mv = memoryview(data)
+        size = len(self.buf)
+        i = 0
+        wait = 0
+        while i < len(mv):
+            with self.lock:
+                m = min(size - (self.wr - self.rd), len(mv) - i)
+                pos = self.wr % size
+                first = min(m, size - pos)
+                self.buf[pos:pos+first] = mv[i:i+first]
+                self.buf[0:m-first] = mv[i+first:i+m]
+                self.wr += m
+            i += m
+            if m == 0:
+                if _thread.get_ident() != self.thread \
+                or wait > _DATA_TIMEOUT*1000:
+                    self.dropped += len(mv) - i
+                    break
+                sleep_ms(_JOB_POLL)
+                wait += _JOB_POLL
         return len(data)
 
+    # bytes up to last line end, or all if full or flush
+    def read_lines(self, flush=False):
+        with self.lock:
+            size = len(self.buf)
+            n = self.wr - self.rd
+            pos = self.rd % size
+            if pos + n <= size:
+                data = bytes(self.buf[pos:pos+n])
+            else:
+                data = bytes(self.buf[pos:]) + bytes(self.buf[:pos+n-size])
+            end = max(data.rfind(b"\n"), data.rfind(b"\r")) + 1
+            if end == 0 and (flush or n == size):
+                end = n
+            self.rd += end
+        return data[:end]
+
     def readinto(self, data):
         return 0
 
+# transfer chunk: power of 2 up to 1/8 of free heap
+# and 4 socket buffers, it takes few readinto() to fill
+def chunk_size(s=None):
+  try:
+    sockbuf = s.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+  except:
+    sockbuf = _SOCK_BUF
+  limit = min(mem_free()//8, 4*sockbuf, _CHUNK_MAX)
+  size = _CHUNK_SIZE
+  while size*2 <= limit:
+    size *= 2
+  return size
+
+# preallocated buffers are reused between transfers
+# instead of new bytes object for each chunk
+def buf_get(size):
+  for i, buf in enumerate(buf_pool):
+    if len(buf) >= size:
+      return buf_pool.pop(i)
+  collect()
+  return bytearray(size)
+
+def buf_put(buf):
+  if len(buf_pool) < _POOL_MAX:
+    buf_pool.append(buf)
+
+# counts bytes that worker thread reads from data socket
+class counter(io.IOBase):
+  def __init__(self, s, client):
+    self.s = s
+    self.client = client
+    self.head = b""
+
+  # read first n bytes, next readinto() returns them again
+  def peek(self, n):
+    head = bytearray(n)
+    m = 0
+    while m < n:
+      r = self.s.readinto(memoryview(head)[m:])
+      if not r:
+        break
+      m += r
+    self.head = head[:m]
+    self.client.count += m
+    return self.head
+
+  def readinto(self, buf):
+    if self.head:
+      n = min(len(buf), len(self.head))
+      buf[:n] = self.head[:n]
+      self.head = self.head[n:]
+      return n
+    n = self.s.readinto(buf)
+    if n:
+      self.client.count += n
+    return n
+
+  def write(self, buf):
+    self.s.write(buf)
+    self.client.count += len(buf)
+    return len(buf)
+
+# HTTP request body: Content-Length or chunked,
+# readinto() returns 0 at end of body
+class http_upload(io.IOBase):
+  def __init__(self, s, length, chunked):
+    self.s = s
+    self.length = length # bytes left, -1: chunked
+    self.chunked = chunked
+    self.chunk = 0 # bytes left in current chunk
+
+  def readinto(self, buf):
+    if self.chunked and self.chunk == 0 and self.length:
+      line = self.s.readline()
+      if line in (b"\r\n", b"\n"): # CRLF after previous chunk
+        line = self.s.readline()
+      self.chunk = int(line.split(b";")[0], 16)
+      if self.chunk == 0: # last chunk, skip trailer
+        while len(self.s.readline()) > 2:
+          pass
+        self.length = 0
+    if self.length == 0:
+      return 0
+    n = min(len(buf), self.chunk if self.chunked else self.length)
+    n = self.s.readinto(memoryview(buf)[:n])
+    if not n:
+      self.length = 0
+      return 0
+    if self.chunked:
+      self.chunk -= n
+    else:
+      self.length -= n
+    return n
+
+# gunzip if name ends with ".gz" or data starts with gzip magic
+def gunzip_stream(data_client, gz):
+  if data_client.peek(3) == b"\x1f\x8b\x08" or gz:
+    try:
+      import deflate
+      return deflate.DeflateIO(data_client)
+    except ImportError:
+      import uzlib
+      return uzlib.DecompIO(data_client,31)
+  return data_client
+
+# directory entries (name, mode, size, mtime), stat
+# is called once per entry and kept until the directory
+# changes, exception if path is not a directory
+def list_dir(path):
+  entry = list_cache.get(path)
+  if entry and ticks_diff(ticks_ms(), entry[0]) < _LIST_CACHE_MS:
+    list_order.remove(path)
+    list_order.append(path)
+    return entry[1]
+  entries = []
+  for fname in os.listdir(path):
+    stat = os.stat(path + fname if path.endswith("/") else path + "/" + fname)
+    entries.append((fname, stat[0], stat[6], stat[7]))
+  if path in list_order:
+    list_order.remove(path)
+  list_order.append(path)
+  list_cache[path] = (ticks_ms(), entries)
+  while len(list_order) > _LIST_CACHE_DIRS:
+    del list_cache[list_order.pop(0)]
+  return entries
+
+# path was created, changed or removed: drop cached
+# listing of its directory (and of itself if directory)
+# path=None: drop all
+def list_invalidate(path=None):
+  if path is None:
+    list_cache.clear()
+    del list_order[:]
+    return
+  for d in (path, path[:path.rfind("/")] or "/"):
+    if d in list_cache:
+      del list_cache[d]
+      list_order.remove(d)
+
+# "async with" placeholder for paths not needing hw_lock
+class nolock:
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *args):
+    pass
+
+# start fn(*args) in a thread with _THREAD_STACK bytes of stack
+# default is too small for deflate, SITE exec and FLASH/SD jobs
+def start_thread(fn, args):
+  try:
+    old = _thread.stack_size(_THREAD_STACK)
+  except ValueError: # size not accepted, keep default
+    old = None
+  try:
+    _thread.start_new_thread(fn, args)
+  finally:
+    if old is not None:
+      _thread.stack_size(old)
+
+# asyncio state (task queue) is global in micropython, loops
+# in two threads (start() and e.g. dualusbserial.py) would
+# run each other's tasks. True if called from a running loop
+def asyncio_running():
+  try:
+    asyncio.current_task()
+    return True
+  except:
+    return False
+
+# run blocking fn(*args) in a worker thread and
+# poll for its end, asyncio loop keeps serving
+async def run_job(fn, *args):
+  job = [None, None, False] # result, exception, done
+  def worker():
+    try:
+      job[0] = fn(*args)
+    except Exception as err:
+      job[1] = err
+    job[2] = True
+  start_thread(worker, ())
+  while not job[2]:
+    await asyncio.sleep_ms(_JOB_POLL)
+  if job[1] is not None:
+    raise job[1]
+  return job[0]
+
+# blocking socket under asyncio stream, for worker thread
+def blocking(stream):
+  s = stream.s
+  s.setblocking(True)
+  s.settimeout(_DATA_TIMEOUT)
+  return s
+
+async def close_stream(stream):
+  try:
+    stream.close()
+    await stream.wait_closed()
+  except:
+    pass
+
+# FLASH@ and SD@ names are raw device addresses, not files
+def virtual(dname):
+  return dname.startswith("FLASH@") or dname.startswith("SD@")
+
+# "FLASH@0x200000-0x3FFFFF" -> (0x200000, 0x200000), end inclusive
+# "SD@-8192" -> (-8192, -1), length -1: until end of device
+def parse_range(dname):
+  r = dname.split("@")[1].lower()
+  i = r.find("-", 1)
+  if i < 0:
+    return int(r,0), -1
+  addr = int(r[:i],0)
+  return addr, int(r[i+1:],0)+1-addr
+
+# worker thread: byte length of FLASH@ or SD@ range
+def size_hw(dname):
+  addr, length = parse_range(dname)
+  if length >= 0:
+    return length
+  if dname.startswith("FLASH@"):
+    size = flash_size()
+  else:
+    import sdraw
+    size = sdraw.size()
+  if addr < 0:
+    return -addr
+  return size-addr
+
+# FLASH chip size, read once. flash_open() erases SRAM and
+# flash_close() reloads the bitstream, FTP clients send SIZE
+# while browsing and shouldn't restart the design each time
+def flash_size():
+  global flash_chip
+  if not flash_chip:
+    import ecp5
+    ecp5.flash_open()
+    flash_chip = ecp5.flash_chip_size()
+    ecp5.flash_close()
+  return flash_chip
+
+# worker thread: RETR of FLASH@ or SD@ range
+# rest: REST offset into the range
+def retr_hw(dname, data_client, chunk=_CHUNK_SIZE, rest=0):
+  addr, length = parse_range(dname)
+  if length < 0:
+    length = size_hw(dname)
+  if rest > length:
+    return False
+  addr += rest
+  length -= rest
+  if dname.startswith("FLASH@"):
+    import ecp5
+    ecp5.flash_open()
+    ecp5.flash_read_stream(data_client, addr, length, chunk)
+    ecp5.flash_close()
+    return True
+  import sdraw
+  return sdraw.sdraw().sd_read_stream(data_client, addr, length, max(chunk, 512))
+
+# worker thread: hex digest of file, FLASH@ or SD@ range
+# start, end: part of it, end exclusive, -1: until end
+# returns (hex, start, end)
+def hash_hw(path, dname, algo, start=0, end=-1):
+  if virtual(dname):
+    addr, length = parse_range(dname)
+    if length < 0:
+      length = size_hw(dname)
+  else:
+    addr, length = 0, os.stat(path)[6]
+  if end < 0 or end > length:
+    end = length
+  if start > end:
+    raise ValueError
+  if dname.startswith("FLASH@"):
+    import ecp5
+    return ecp5.flash_hash(addr+start, end-start, algo), start, end
+  if dname.startswith("SD@"):
+    import sdraw
+    return sdraw.hash(addr+start, end-start, algo), start, end
+  from binascii import hexlify
+  from hashsum import hash_new
+  h = hash_new(algo)
+  buf = buf_get(chunk_size())
+  mv = memoryview(buf)
+  try:
+    with open(path, "rb") as file:
+      file.seek(start)
+      n = end-start
+      while n > 0:
+        r = file.readinto(mv[:min(n, len(buf))])
+        if not r:
+          break
+        h.update(mv[:r])
+        n -= r
+  finally:
+    buf_put(buf)
+  return hexlify(h.digest()).decode(), start, end
+
+# worker thread: STOR to virtual FPGA, FLASH@ or SD@ file
+# dname: upper case "FPGA", "FLASH@0X200000", "SD@0.GZ", ...
+# rest: REST offset, FLASH and SD continue from erase block or
+# 512-byte sector start, already written head is read back
+# and sent again before the rest of data
+def store_hw(dname, data_client, chunk=_CHUNK_SIZE, rest=0):
+  result = False
+  gz = dname.endswith(".GZ")
+  if gz:
+    dname = dname[:-3]
+  if rest:
+    if gz or dname == "FPGA": # can't continue these streams
+      return False
+    dstream = data_client
+  else:
+    dstream = gunzip_stream(data_client, gz)
+  if dname == "FPGA":
+    import ecp5
+    ecp5.prog_stream(dstream,chunk)
+    result = ecp5.prog_close()
+  elif dname.startswith("FLASH@"):
+    import ecp5
+    addr = parse_range(dname)[0]
+    if rest:
+      addr += rest
+      start = addr & ~(ecp5.flash_erase_size-1)
+      if addr > start:
+        data_client.head = bytearray(addr-start)
+        ecp5.flash_read(data_client.head, start)
+      addr = start
+    result = ecp5.flash_stream(dstream,addr)
+    ecp5.flash_close()
+  elif dname.startswith("SD@"):
+    import sdraw
+    addr = parse_range(dname)[0]
+    if rest:
+      addr += rest
+      start = addr & ~0x1FF
+      if addr > start:
+        data_client.head = sdraw.read(start, 512)[:addr-start]
+      addr = start
+    sd_raw = sdraw.sdraw()
+    result = sd_raw.sd_write_stream(dstream,addr)
+    del sd_raw
+  return result
+
+# worker thread: SITE file.bit, returns reply
+def site_prog(path):
+  import ecp5
+  if not ecp5.prog(path, close=False):
+    return '550 Fail\r\n'
+  reply = ""
+  if path.startswith("/sd/"):
+    try:
+      umount()
+      reply = '250-umount /sd OK\r\n'
+    except:
+      reply = '550-umount /sd Fail\r\n'
+  if ecp5.prog_close():
+    return reply + '250 OK\r\n'
+  return reply + '550 Fail\r\n'
+
+# worker thread: SITE python, output goes to dup
+def site_exec(payload, dup):
+  dup.thread = _thread.get_ident()
+  os.dupterm(dup)
+  try:
+    exec(payload)
+  finally:
+    os.dupterm(None)
+
 class FTP_client:
-  def __init__(self, ftpsocket):
+  def __init__(self, cl):
     global AP_addr, STA_addr
-    self.command_client, self.remote_addr = ftpsocket.accept()
-    self.remote_addr = self.remote_addr[0]
-    self.command_client.settimeout(_COMMAND_TIMEOUT)
+    self.command_client = cl
+    self.remote_addr = cl.get_extra_info("peername")[0]
     log_msg(1, "FTP Command connection from:", self.remote_addr)
-    self.command_client.setsockopt(socket.SOL_SOCKET,
-                                   _SO_REGISTER_HANDLER,
-                                   self.exec_ftp_command)
-    self.command_client.sendall("220 Hello, this is the ULX3S.\r\n")
     self.cwd = '/'
     self.fromname = None
     # self.logged_in = False
     self.act_data_addr = self.remote_addr
     self.DATA_PORT = 20
     self.active = True
+    self.task = None # running transfer
+    self.held = None # replies waiting for end of multiline reply
+    self.data_client = None
+    self.hw = False # transfer is a hardware job
+    self.aborted = False
+    self.count = 0 # bytes of current transfer
+    self.quit = False
+    self.rest = 0 # REST offset for next transfer
+    self.hash_algo = "SHA-256" # for HASH command
+    self.pasv_port = 0 # allocated passive data port
+    self.data_waiting = None # accepted passive data connection
     # check which interface was used by comparing the caller's ip
     # adress with the ip adresses of STA and AP; consider netmask;
     # select IP address for passive mode
@@ -135,29 +613,61 @@ class FTP_client:
     else:
         self.pasv_data_addr = "0.0.0.0"  # Invalid value
 
-  def send_list_data(self, path, data_client, full):
+  async def reply(self, msg):
+    self.command_client.write(msg.encode())
+    await self.command_client.drain()
+
+  # reply to NOOP/STAT during a transfer. while SITE sends
+  # 250- lines it waits for the final "250 " line
+  async def reply_busy(self, msg):
+    if self.held is None:
+      await self.reply(msg)
+    else:
+      self.held.append(msg)
+
+  async def reply_held(self):
+    held, self.held = self.held, None
+    for msg in held:
+      await self.reply(msg)
+
+  # full: 0 names, 1 "ls -l" lines, 2 MLSD facts
+  # lines are collected and sent in MTU sized writes
+  async def send_list_data(self, path, data_client, full):
+    pattern = None
     try:
-      for fname in os.listdir(path):
-        data_client.sendall(self.make_description(path, fname, full))
+      entries = list_dir(path)
     except:  # path may be a file name or pattern
       path, pattern = self.split_path(path)
       try:
-        for fname in os.listdir(path):
-          if self.fncmp(fname, pattern):
-            data_client.sendall(
-              self.make_description(path, fname, full))
+        entries = list_dir(path)
       except:
-          pass
+        return
+    out = bytearray()
+    for entry in entries:
+      if pattern is None or self.fncmp(entry[0], pattern):
+        out += self.make_description(entry, full).encode()
+        if len(out) >= _MTU:
+          data_client.write(out)
+          await data_client.drain()
+          out = bytearray()
+    if out:
+      data_client.write(out)
+      await data_client.drain()
 
-  def make_description(self, path, fname, full):
+  # entry: (name, mode, size, mtime) from list_dir()
+  def make_description(self, entry, full):
     global _month_name
+    fname, mode, file_size, mtime = entry
     if full:
-      stat = os.stat(self.get_absolute_path(path, fname))
+      tm = localtime(mtime if mtime<0x80000000 else mtime-0x100000000)
+    if full == 2:
+      description = "type={};size={};modify={:04}{:02}{:02}{:02}{:02}{:02}; {}\r\n".\
+        format("dir" if mode & 0o170000 == 0o040000 else "file",
+               file_size, tm[0], tm[1], tm[2], tm[3], tm[4], tm[5], fname)
+    elif full:
       file_permissions = ("drwxr-xr-x"
-                          if (stat[0] & 0o170000 == 0o040000)
+                          if (mode & 0o170000 == 0o040000)
                           else "-rw-r--r--")
-      file_size = stat[6]
-      tm = localtime(stat[7] if stat[7]<0x80000000 else stat[7]-0x100000000)
       if tm[0] != localtime()[0]:
         description = "{} 1 owner group {:>10} {} {:2} {:>5} {}\r\n".\
           format(file_permissions, file_size,
@@ -170,21 +680,44 @@ class FTP_client:
       description = fname + "\r\n"
     return description
 
-  def send_file_data(self, path, data_client):
-    with open(path,"rb") as file:
-      chunk = file.read(_CHUNK_SIZE)
-      while len(chunk) > 0:
-        data_client.sendall(chunk)
-        chunk = file.read(_CHUNK_SIZE)
-      data_client.close()
-
-  def save_file_data(self, path, data_client, mode):
-    with open(path, mode) as file:
-      chunk = data_client.recv(_CHUNK_SIZE)
-      while len(chunk) > 0:
-        file.write(chunk)
-        chunk = data_client.recv(_CHUNK_SIZE)
-      data_client.close()
+  async def send_file_data(self, path, data_client, rest=0):
+    buf = buf_get(chunk_size(data_client.s))
+    mv = memoryview(buf)
+    try:
+      with open(path,"rb") as file:
+        file.seek(rest)
+        n = file.readinto(buf)
+        while n:
+          data_client.write(mv[:n])
+          await data_client.drain()
+          self.count += n
+          n = file.readinto(buf)
+    finally:
+      buf_put(buf)
+
+  async def save_file_data(self, path, data_client, mode, rest=0):
+    if rest: # continue upload, overwrite from rest
+      if rest > os.stat(path)[6]:
+        raise OSError(22) # EINVAL
+      mode = "r+b"
+    buf = buf_get(chunk_size(data_client.s))
+    mv = memoryview(buf)
+    try:
+      with open(path, mode) as file:
+        file.seek(rest)
+        n = await data_client.readinto(buf)
+        while n:
+          file.write(mv[:n])
+          self.count += n
+          n = await data_client.readinto(buf)
+    finally:
+      buf_put(buf)
+
+  # 226 reply with transfer speed
+  def done_reply(self, t0):
+    ms = ticks_diff(ticks_ms(), t0)
+    return "226 Done, {} bytes in {} ms ({} kB/s).\r\n".format(
+      self.count, ms, self.count//ms if ms else 0)
 
   def get_absolute_path(self, cwd, payload):
     # Just a few special cases "..", "." and ""
@@ -233,40 +766,103 @@ class FTP_client:
     else:
       return False
 
-  def open_dataclient(self):
+  # SD card files wait while a hardware job runs
+  def lock(self, path):
+    if path.startswith("/sd"):
+      return hw_lock
+    return nolock()
+
+  async def open_dataclient(self):
     if self.active:  # active mode
-      data_client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      data_client.settimeout(_DATA_TIMEOUT)
-      data_client.connect((self.act_data_addr, self.DATA_PORT))
+      data_client = (await asyncio.wait_for(asyncio.open_connection(
+        self.act_data_addr, self.DATA_PORT), _DATA_TIMEOUT))[1]
       log_msg(1, "FTP Data connection with:", self.act_data_addr)
     else:  # passive mode
-      data_client, data_addr = datasocket.accept()
-      log_msg(1, "FTP Data connection with:", data_addr[0])
+      t0 = ticks_ms()
+      while self.data_waiting is None:
+        if (not self.pasv_port or
+            ticks_diff(ticks_ms(), t0) > _PASV_TIMEOUT):
+          raise OSError(110) # ETIMEDOUT or port taken by other client
+        await asyncio.sleep_ms(10)
+      data_client = self.data_waiting
+      self.data_waiting = None
+      # port is free for the next PASV/EPSV of any client
+      await data_port_free(self)
+      log_msg(1, "FTP Data connection with:", self.remote_addr)
+    self.data_client = data_client
     return data_client
 
-  def exec_ftp_command(self, cl):
-    global datasocket
-    global client_busy
-    global my_ip_addr
+  async def close_dataclient(self):
+    if self.data_client is not None:
+      await close_stream(self.data_client)
+      self.data_client = None
 
-    try:
-      collect()
-
-      data = cl.readline().decode("utf-8").rstrip("\r\n")
+  def busy(self):
+    return self.task is not None and not self.task.done()
 
+  # one task per command connection
+  async def session(self):
+    cl = self.command_client
+    await self.reply("220 Hello, this is the ULX3S.\r\n")
+    while not self.quit:
+      # no timeout while own transfer runs
+      data = await asyncio.wait_for(cl.readline(),
+        None if self.busy() else _COMMAND_TIMEOUT)
+      data = data.decode("utf-8").rstrip("\r\n")
       if len(data) <= 0:
-          # No data, close
-          # This part is NOT CLEAN; there is still a chance that a
-          # closing data connection will be signalled as closing
-          # command connection
-          log_msg(1, "*** No data, assume QUIT")
-          close_client(cl)
-          return
-
-      if client_busy:  # check if another client is busy
-          cl.sendall("400 Device busy.\r\n")  # tell so the remote client
-          return  # and quit
-      client_busy = True  # now it's my turn
+        log_msg(1, "*** No data, assume QUIT")
+        break
+      command = data.split()[0].upper()
+      if self.busy():
+        if command in ("NOOP", "STAT", "ABOR"):
+          await self.exec_busy_command(command)
+          continue
+        await self.task # replies stay in order
+      if command in ("LIST", "NLST", "MLSD", "RETR", "STOR", "APPE", "SITE",
+                     "XCRC", "XMD5", "XSHA1", "XSHA256", "HASH"):
+        self.task = asyncio.create_task(self.exec_ftp_command(data))
+      else:
+        await self.exec_ftp_command(data)
+    if self.busy(): # let hardware job finish
+      await self.task
+
+  # commands answered while this client's transfer is running
+  async def exec_busy_command(self, command):
+    log_msg(1, "Command={} during transfer".format(command))
+    if command == "NOOP":
+      await self.reply_busy('200 OK\r\n')
+    elif command == "STAT":
+      await self.reply_busy('213 Transfer in progress, {} bytes\r\n'.format(self.count))
+    elif self.hw: # ABOR, JTAG job can't be interrupted
+      await self.task
+      await self.reply('226 Done.\r\n')
+    else: # ABOR, transfer task replies 426
+      self.aborted = True
+      self.task.cancel()
+      try:
+        await self.task
+      except:
+        pass
+      await self.reply('226 Done.\r\n')
+
+  # SITE output as 250- continuation lines
+  # returns number of lines sent
+  async def send_lines(self, data):
+    lines = 0
+    for line in data.replace(b"\r", b"\n").split(b"\n"):
+      if line:
+        self.command_client.write(b"250-" + line + b"\r\n")
+        lines += 1
+    if lines:
+      await self.command_client.drain()
+    return lines
+
+  async def reply_fail(self):
+    await self.reply('426 Aborted.\r\n' if self.aborted else '550 Fail\r\n')
+
+  async def exec_ftp_command(self, data):
+    try:
+      collect()
 
       # check for log-in state may done here, like
       # if self.logged_in == False and not command in\
@@ -278,10 +874,15 @@ class FTP_client:
       payload = data[len(command):].lstrip()  # partition is missing
       path = self.get_absolute_path(self.cwd, payload)
       log_msg(1, "Command={}, Payload={}".format(command, payload))
+      self.hw = False
+      self.aborted = False
+      self.count = 0
+      rest = self.rest # applies only to next command
+      self.rest = 0
 
       if command == "USER":
         # self.logged_in = True
-        cl.sendall("230 Logged in.\r\n")
+        await self.reply("230 Logged in.\r\n")
         # If you want to see a password,return
         #   "331 Need password.\r\n" instead
         # If you want to reject an user, return
@@ -290,30 +891,45 @@ class FTP_client:
         # you may check here for a valid password and return
         # "530 Not logged in.\r\n" in case it's wrong
         # self.logged_in = True
-        cl.sendall("230 Logged in.\r\n")
+        await self.reply("230 Logged in.\r\n")
       elif command == "SYST":
-        cl.sendall("215 UNIX Type: L8\r\n")
+        await self.reply("215 UNIX Type: L8\r\n")
       elif command in ("TYPE", "NOOP", "ABOR"):  # just accept & ignore
-        cl.sendall('200 OK\r\n')
+        await self.reply('200 OK\r\n')
       elif command == "QUIT":
-        cl.sendall('221 Bye.\r\n')
-        close_client(cl)
+        await self.reply('221 Bye.\r\n')
+        self.quit = True
       elif command == "PWD" or command == "XPWD":
-        cl.sendall('257 "{}"\r\n'.format(self.cwd))
+        await self.reply('257 "{}"\r\n'.format(self.cwd))
       elif command == "CWD" or command == "XCWD":
         try:
           if (os.stat(path)[0] & 0o170000) == 0o040000:
             self.cwd = path
-            cl.sendall('250 OK\r\n')
+            await self.reply('250 OK\r\n')
           else:
-            cl.sendall('550 Fail\r\n')
+            await self.reply('550 Fail\r\n')
         except:
-          cl.sendall('550 Fail\r\n')
-      elif command == "PASV":
-        cl.sendall('227 Entering Passive Mode ({},{},{}).\r\n'.format(
-          self.pasv_data_addr.replace('.', ','),
-          _DATA_PORT >> 8, _DATA_PORT % 256))
-        self.active = False
+          await self.reply('550 Fail\r\n')
+      elif command == "PASV" or command == "EPSV":
+        if command == "EPSV" and payload.upper() == "ALL":
+          await self.reply('200 OK\r\n')
+        elif not await data_port_alloc(self):
+          await self.reply('425 No free data port.\r\n')
+        elif command == "PASV":
+          await self.reply('227 Entering Passive Mode ({},{},{}).\r\n'.format(
+            self.pasv_data_addr.replace('.', ','),
+            self.pasv_port >> 8, self.pasv_port % 256))
+          self.active = False
+        else:
+          await self.reply('229 Entering Extended Passive Mode (|||{}|).\r\n'.format(
+            self.pasv_port))
+          self.active = False
+      elif command == "REST":
+        try:
+          self.rest = int(payload)
+          await self.reply('350 Restarting at {}.\r\n'.format(self.rest))
+        except:
+          await self.reply('501 Fail\r\n')
       elif command == "PORT":
         items = payload.split(",")
         if len(items) >= 6:
@@ -322,10 +938,32 @@ class FTP_client:
             # replace by command session addr
             self.act_data_addr = self.remote_addr
           self.DATA_PORT = int(items[4]) * 256 + int(items[5])
-          cl.sendall('200 OK\r\n')
+          await data_port_free(self)
+          await self.reply('200 OK\r\n')
           self.active = True
         else:
-            cl.sendall('504 Fail\r\n')
+            await self.reply('504 Fail\r\n')
+      elif command == "MLSD":
+        try:
+          data_client = await self.open_dataclient()
+          await self.reply("150 Directory listing:\r\n")
+          async with self.lock(path):
+            list_dir(path) # 550 if not a directory
+            await self.send_list_data(path, data_client, 2)
+          await self.close_dataclient()
+          await self.reply("226 Done.\r\n")
+        except:
+          await self.reply_fail()
+        await self.close_dataclient()
+      elif command == "MLST":
+        try:
+          async with self.lock(path):
+            stat = os.stat(path)
+          await self.reply("250-Listing {}\r\n {}250 End.\r\n".format(
+            payload, self.make_description(
+              (path, stat[0], stat[6], stat[7]), 2)))
+        except:
+          await self.reply('550 Fail\r\n')
       elif command == "LIST" or command == "NLST":
         if payload.startswith("-"):
           option = payload.split()[0].lower()
@@ -334,79 +972,137 @@ class FTP_client:
         else:
           option = ""
         try:
-          data_client = self.open_dataclient()
-          cl.sendall("150 Directory listing:\r\n")
-          self.send_list_data(path, data_client,
-            command == "LIST" or 'l' in option)
-          cl.sendall("226 Done.\r\n")
-          data_client.close()
+          data_client = await self.open_dataclient()
+          await self.reply("150 Directory listing:\r\n")
+          async with self.lock(path):
+            await self.send_list_data(path, data_client,
+              int(command == "LIST" or 'l' in option))
+          await self.close_dataclient()
+          await self.reply("226 Done.\r\n")
         except:
-          cl.sendall('550 Fail\r\n')
-          if data_client is not None:
-            data_client.close()
+          await self.reply_fail()
+        await self.close_dataclient()
       elif command == "RETR":
         try:
-          data_client = self.open_dataclient()
-          cl.sendall("150 Opened data connection.\r\n")
-          self.send_file_data(path, data_client)
-          # if the next statement is reached,
-          # the data_client was closed.
-          data_client = None
-          cl.sendall("226 Done.\r\n")
+          data_client = await self.open_dataclient()
+          await self.reply("150 Opened data connection.\r\n")
+          t0 = ticks_ms()
+          dname = payload.split()[-1].upper()
+          if virtual(dname):
+            self.hw = True
+            async with hw_lock:
+              t0 = ticks_ms()
+              s = blocking(data_client)
+              if not await run_job(retr_hw, dname,
+                                   counter(s, self), chunk_size(s), rest):
+                raise OSError(5)
+          else:
+            async with self.lock(path):
+              await self.send_file_data(path, data_client, rest)
+          await self.close_dataclient()
+          await self.reply(self.done_reply(t0))
         except:
-          cl.sendall('550 Fail\r\n')
-          if data_client is not None:
-            data_client.close()
+          await self.reply_fail()
+        await self.close_dataclient()
       elif command == "STOR" or command == "APPE":
         result = False
         try:
-          data_client = self.open_dataclient()
-          cl.sendall("150 Opened data connection.\r\n")
+          data_client = await self.open_dataclient()
+          await self.reply("150 Opened data connection.\r\n")
+          t0 = ticks_ms()
           dname = payload.split()[-1].upper()
-          if dname == "FPGA":
-            import ecp5
-            ecp5.prog_stream(data_client,_CHUNK_SIZE)
-            result = ecp5.prog_close()
-            data_client.close()
-          elif dname.startswith("FLASH@"):
-            import ecp5
-            dummy, addr = path.split("@")
-            addr = int(addr,0)
-            result = ecp5.flash_stream(data_client,addr)
-            ecp5.flash_close()
-            del addr, dummy
-            data_client.close()
-          elif dname.startswith("SD@"):
-            import sdraw
-            dummy, addr = path.split("@")
-            addr = int(addr,0)
-            sd_raw = sdraw.sdraw()
-            result = sd_raw.sd_write_stream(data_client,addr)
-            del sd_raw, addr, dummy
-            data_client.close()
+          if dname == "FPGA" or dname == "FPGA.GZ" or virtual(dname):
+            self.hw = True
+            async with hw_lock:
+              t0 = ticks_ms()
+              s = blocking(data_client)
+              result = await run_job(store_hw, dname,
+                                     counter(s, self), chunk_size(s),
+                                     rest if command == "STOR" else 0)
           else:
-            self.save_file_data(path, data_client,
-                                "w" if command == "STOR" else "a")
+            try:
+              async with self.lock(path):
+                await self.save_file_data(path, data_client,
+                                          "w" if command == "STOR" else "a",
+                                          rest if command == "STOR" else 0)
+            finally:
+              list_invalidate(path)
             result = True
-          # if the next statement is reached,
-          # the data_client was closed.
-          data_client = None
         except:
-          if data_client is not None:
-            data_client.close()
+          pass
+        await self.close_dataclient()
         if result:
-          cl.sendall("226 Done.\r\n")
+          await self.reply(self.done_reply(t0))
         else:
-          cl.sendall('550 Fail\r\n')
+          await self.reply_fail()
         del result
       elif command == "SIZE":
         try:
-          cl.sendall('213 {}\r\n'.format(os.stat(path)[6]))
+          dname = payload.split()[-1].upper()
+          if virtual(dname):
+            async with hw_lock:
+              size = await run_job(size_hw, dname)
+          else:
+            size = os.stat(path)[6]
+          await self.reply('213 {}\r\n'.format(size))
+        except:
+          await self.reply('550 Fail\r\n')
+      elif command in ("XCRC", "XMD5", "XSHA1", "XSHA256", "HASH"):
+        # XCRC name [start [end]], HASH name with OPTS HASH algorithm
+        try:
+          items = payload.split()
+          arg = []
+          while command != "HASH" and len(items) > 1 and len(arg) < 2 \
+          and items[-1].isdigit():
+            arg.insert(0, int(items.pop()))
+          name = " ".join(items)
+          path = self.get_absolute_path(self.cwd, name)
+          dname = name.upper()
+          if command == "HASH":
+            algo = self.hash_algo
+          else:
+            algo = {"XCRC":"CRC32", "XMD5":"MD5", "XSHA1":"SHA-1",
+                    "XSHA256":"SHA-256"}[command]
+          if virtual(dname):
+            self.hw = True
+            lock = hw_lock
+          else:
+            lock = self.lock(path)
+          async with lock:
+            digest, start, end = await run_job(hash_hw, path, dname,
+                                               _hash_algo[algo], *arg)
+          if command == "HASH":
+            await self.reply('213 {} {}-{} {} {}\r\n'.format(
+                             algo, start, end, digest, name))
+          else:
+            await self.reply('250 {}\r\n'.format(digest.upper()))
         except:
-          cl.sendall('550 Fail\r\n')
+          await self.reply('550 Fail\r\n')
+      elif command == "OPTS":
+        items = payload.upper().split()
+        if len(items) == 1 and items[0] == "HASH":
+          await self.reply('200 {}\r\n'.format(self.hash_algo))
+        elif len(items) == 2 and items[0] == "HASH" \
+        and items[1] in _hash_algo:
+          self.hash_algo = items[1]
+          await self.reply('200 {}\r\n'.format(self.hash_algo))
+        else:
+          await self.reply('501 Unsupported option.\r\n')
+      elif command == "FEAT":
+        await self.reply("211-Features:\r\n"
+                         " EPSV\r\n"
+                         " SIZE\r\n"
+                         " REST STREAM\r\n"
+                         " XCRC\r\n"
+                         " XMD5\r\n"
+                         " XSHA1\r\n"
+                         " XSHA256\r\n"
+                         " MLST type*;size*;modify*;\r\n"
+                         " HASH SHA-256*;SHA-1;MD5;CRC32\r\n"
+                         "211 End\r\n")
       elif command == "STAT":
         if payload == "":
-          cl.sendall("211-Connected to ({})\r\n"
+          await self.reply("211-Connected to ({})\r\n"
                      "    Data address ({})\r\n"
                      "    TYPE: Binary STRU: File MODE: Stream\r\n"
                      "    Session timeout {}\r\n"
@@ -414,88 +1110,94 @@ class FTP_client:
                       self.remote_addr, self.pasv_data_addr,
                       _COMMAND_TIMEOUT, len(client_list)))
         else:
-          cl.sendall("213-Directory listing:\r\n")
-          self.send_list_data(path, cl, True)
-          cl.sendall("213 Done.\r\n")
+          await self.reply("213-Directory listing:\r\n")
+          async with self.lock(path):
+            await self.send_list_data(path, self.command_client, 1)
+          await self.reply("213 Done.\r\n")
       elif command == "DELE":
         try:
-          os.remove(path)
-          cl.sendall('250 OK\r\n')
+          async with self.lock(path):
+            os.remove(path)
+          list_invalidate(path)
+          await self.reply('250 OK\r\n')
         except:
-          cl.sendall('550 Fail\r\n')
+          await self.reply('550 Fail\r\n')
       elif command == "RNFR":
         try:
           # just test if the name exists, exception if not
           os.stat(path)
           self.fromname = path
-          cl.sendall("350 Rename from\r\n")
+          await self.reply("350 Rename from\r\n")
         except:
-          cl.sendall('550 Fail\r\n')
+          await self.reply('550 Fail\r\n')
       elif command == "RNTO":
         try:
-          os.rename(self.fromname, path)
-          cl.sendall('250 OK\r\n')
+          async with self.lock(path):
+            os.rename(self.fromname, path)
+          list_invalidate(self.fromname)
+          list_invalidate(path)
+          await self.reply('250 OK\r\n')
         except:
-          cl.sendall('550 Fail\r\n')
+          await self.reply('550 Fail\r\n')
         self.fromname = None
       elif command == "CDUP" or command == "XCUP":
         self.cwd = self.get_absolute_path(self.cwd, "..")
-        cl.sendall('250 OK\r\n')
+        await self.reply('250 OK\r\n')
       elif command == "RMD" or command == "XRMD":
         try:
           os.rmdir(path)
-          cl.sendall('250 OK\r\n')
+          list_invalidate(path)
+          await self.reply('250 OK\r\n')
         except:
-          cl.sendall('550 Fail\r\n')
+          await self.reply('550 Fail\r\n')
       elif command == "MKD" or command == "XMKD":
         try:
           os.mkdir(path)
-          cl.sendall('250 OK\r\n')
+          list_invalidate(path)
+          await self.reply('250 OK\r\n')
         except:
-          cl.sendall('550 Fail\r\n')
+          await self.reply('550 Fail\r\n')
       elif command == "SITE":
         collect()
+        self.hw = True
+        list_invalidate() # python may change any file
         if path.endswith(".bit") or path.endswith(".bit.gz"):
           try:
-            import ecp5
-            if ecp5.prog(path, close=False):
-              if path.startswith("/sd/"):
-                try:
-                  umount()
-                  cl.sendall('250-umount /sd OK\r\n')
-                except:
-                  cl.sendall('550-umount /sd Fail\r\n')
-              if ecp5.prog_close():
-                cl.sendall('250 OK\r\n')
-              else:
-                cl.sendall('550 Fail\r\n')
-            else:
-              cl.sendall('550 Fail\r\n')
+            async with hw_lock:
+              await self.reply(await run_job(site_prog, path))
           except:
-            cl.sendall('550 Fail\r\n')
+            await self.reply('550 Fail\r\n')
         else:
+          sent = 0
+          self.held = []
           try:
-            stdout=bytearray()
-            os.dupterm(DUP(stdout))
-            exec(payload)
-            os.dupterm(None)
-            cl.sendall('250-\r\n')
-            for line in stdout.decode("utf-8").splitlines():
-              cl.sendall(line+'\r\n')
-            cl.sendall('250 OK\r\n')
-            del stdout
-          except:
-            cl.sendall('550 Fail '+payload+'\r\n')
+            async with hw_lock:
+              dup = DUP()
+              job = asyncio.create_task(run_job(site_exec, payload, dup))
+              # stream output while exec() runs
+              while not job.done():
+                await asyncio.sleep_ms(_JOB_POLL)
+                sent += await self.send_lines(dup.read_lines())
+              sent += await self.send_lines(dup.read_lines(True))
+              if dup.dropped:
+                await self.reply('250-... {} bytes dropped\r\n'.format(dup.dropped))
+              await job # exception from exec()
+            await self.reply('250 OK\r\n')
+          except Exception as err:
+            if sent: # reply code must match already sent 250- lines
+              await self.reply('250-{}\r\n250 Fail {}\r\n'.format(err, payload))
+            else:
+              await self.reply('550 Fail '+payload+'\r\n')
+          finally:
+            await self.reply_held()
       else:
-        cl.sendall("502 Unsupported command.\r\n")
+        await self.reply("502 Unsupported command.\r\n")
         # log_msg(2,
         #  "Unsupported command {} with payload {}".format(command,
         #  payload))
     # handle unexpected errors
     except Exception as err:
       log_msg(1, "Exception in exec_ftp_command: {}".format(err))
-    # tidy up before leaving
-    client_busy = False
 
 def log_msg(level, *args):
   global verbose_l
@@ -503,76 +1205,272 @@ def log_msg(level, *args):
     print(*args)
 
 # close client and remove it from the list
-def close_client(cl):
-  cl.setsockopt(socket.SOL_SOCKET, _SO_REGISTER_HANDLER, None)
-  cl.close()
-  for i, client in enumerate(client_list):
-    if client.command_client == cl:
-      del client_list[i]
-      break
-
-def accept_ftp_connect(ftpsocket):
+async def close_client(client):
+  await client.close_dataclient()
+  await data_port_free(client)
+  await close_stream(client.command_client)
+  if client in client_list:
+    client_list.remove(client)
+
+async def accept_ftp_connect(reader, writer):
   # Accept new calls for the server
   try:
-    client_list.append(FTP_client(ftpsocket))
+    client = FTP_client(writer)
   except:
     log_msg(1, "Attempt to connect failed")
-    # try at least to reject
+    await close_stream(writer)
+    return
+  client_list.append(client)
+  try:
+    await client.session()
+  except Exception as err:
+    log_msg(1, "FTP session ended: {}".format(err))
+  await close_client(client)
+
+# give client a passive port: a free one or one whose
+# owner didn't connect since _PASV_TIMEOUT. ports are
+# held only until connect, wait a while for one to free up.
+# 0 if none is free
+async def data_port_alloc(client):
+  await data_port_free(client)
+  t0 = ticks_ms()
+  while True:
+    now = ticks_ms()
+    for port in data_ports:
+      owner, t = data_ports[port]
+      if owner is None or (not owner.busy() and
+                           ticks_diff(now, t) > _PASV_TIMEOUT):
+        if owner is not None:
+          await data_port_free(owner)
+        data_ports[port] = [client, now]
+        client.pasv_port = port
+        return port
+    if ticks_diff(now, t0) > _PASV_TIMEOUT:
+      return 0
+    await asyncio.sleep_ms(10)
+
+# release client's passive port, close unused connection
+async def data_port_free(client):
+  if client.pasv_port:
+    if data_ports.get(client.pasv_port, [None])[0] is client:
+      data_ports[client.pasv_port] = [None, ticks_ms()]
+    client.pasv_port = 0
+  if client.data_waiting is not None:
+    await close_stream(client.data_waiting)
+    client.data_waiting = None
+
+# passive data connection waits in owner's data_waiting
+# until its transfer command picks it up
+async def accept_data_connect(reader, writer, port):
+  owner = data_ports[port][0]
+  # drop connections nobody asked for
+  if owner is None or owner.data_waiting is not None:
+    await close_stream(writer)
+    return
+  owner.data_waiting = writer
+  data_ports[port][1] = ticks_ms()
+
+_http_status = {200:"OK", 400:"Bad Request", 404:"Not Found",
+                405:"Method Not Allowed", 500:"Internal Server Error"}
+
+# one HTTP request per connection:
+# PUT /fpga, PUT /flash/addr, PUT /sd/addr,
+# GET /flash/addr[-end], GET /sd/addr[-end]
+class HTTP_client:
+  def __init__(self, stream):
+    self.stream = stream
+    self.count = 0 # bytes of body transferred
+    self.hdrs = {}
+    self.sent = False # status line sent, no other reply possible
+
+  async def reply(self, status, body="", hdrs=""):
+    self.sent = True
+    self.stream.write("HTTP/1.1 {} {}\r\nContent-Length: {}\r\n"
+                      "Connection: close\r\n{}\r\n{}".format(
+                      status, _http_status[status], len(body), hdrs, body).encode())
+    await self.stream.drain()
+
+  async def session(self):
+    cl = self.stream
+    line = await asyncio.wait_for(cl.readline(), _COMMAND_TIMEOUT)
+    items = line.decode("utf-8").split()
+    if len(items) < 3:
+      await self.reply(400)
+      return
+    method, path = items[0].upper(), items[1].rstrip("/")
+    log_msg(1, "HTTP {} {}".format(method, path))
+    for i in range(_HTTP_HEADERS):
+      line = await asyncio.wait_for(cl.readline(), _COMMAND_TIMEOUT)
+      if len(line) < 3: # empty line ends headers
+        break
+      name, _, value = line.decode("utf-8").partition(":")
+      self.hdrs[name.strip().lower()] = value.strip()
+    # "/flash/0x200000-0x2FFFFF" -> "FLASH@0X200000-0X2FFFFF"
+    dev, _, arg = path[1:].upper().partition("/")
+    if dev == "FPGA" and not arg:
+      dname = dev
+    elif (dev == "FLASH" or dev == "SD") and arg:
+      dname = dev + "@" + arg
+    else:
+      await self.reply(404)
+      return
     try:
-      temp_client, temp_addr = ftpsocket.accept()
-      temp_client.close()
-    except:
-      pass
+      if method == "PUT" or method == "POST":
+        await self.put(dname)
+      elif method == "GET" and dname != "FPGA":
+        await self.get(dname)
+      else:
+        await self.reply(405)
+    except Exception as err:
+      log_msg(1, "HTTP failed: {}".format(err))
+      # after status line connection is closed,
+      # client sees body shorter than Content-Length
+      if not self.sent:
+        await self.reply(500, "FAIL\n")
+
+  async def put(self, dname):
+    chunked = self.hdrs.get("transfer-encoding", "").lower() == "chunked"
+    length = int(self.hdrs.get("content-length", "-1"))
+    if length < 0 and not chunked:
+      await self.reply(400)
+      return
+    if self.hdrs.get("content-encoding", "").lower() == "gzip":
+      dname += ".GZ"
+    if self.hdrs.get("expect", "").lower() == "100-continue":
+      self.stream.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+      await self.stream.drain()
+    async with hw_lock:
+      t0 = ticks_ms()
+      s = blocking(self.stream)
+      result = await run_job(store_hw, dname,
+                             counter(http_upload(s, length, chunked), self),
+                             chunk_size(s))
+      ms = ticks_diff(ticks_ms(), t0)
+    body = "{}, {} bytes in {} ms ({} kB/s).\n".format(
+      "Done" if result else "Fail", self.count, ms, self.count//ms if ms else 0)
+    if dname.startswith("FLASH@"):
+      import ecp5
+      body += "{}K blocks: {} total, {} erased, {} written, {} pages.\n".format(
+        ecp5.flash_erase_size >> 10, ecp5.count_total, ecp5.count_erase,
+        ecp5.count_write, ecp5.count_write_bytes // ecp5.flash_write_size)
+    await self.reply(200 if result else 500, body,
+                     "Server-Timing: hw;dur={}\r\n".format(ms))
+
+  async def get(self, dname):
+    async with hw_lock:
+      size = await run_job(size_hw, dname)
+      self.sent = True
+      self.stream.write("HTTP/1.1 200 OK\r\nContent-Length: {}\r\n"
+        "Content-Type: application/octet-stream\r\n"
+        "Connection: close\r\n\r\n".format(size).encode())
+      await self.stream.drain()
+      s = blocking(self.stream)
+      if not await run_job(retr_hw, dname, counter(s, self), chunk_size(s)):
+        raise OSError(5)
+
+async def accept_http_connect(reader, writer):
+  http_list.append(writer)
+  try:
+    await HTTP_client(writer).session()
+  except Exception as err:
+    log_msg(1, "HTTP session ended: {}".format(err))
+  if writer in http_list:
+    http_list.remove(writer)
+  await close_stream(writer)
 
 def num_ip(ip):
   items = ip.split(".")
   return (int(items[0]) << 24 | int(items[1]) << 16 |
           int(items[2]) <<  8 | int(items[3]))
 
+async def serve(port, http):
+  global run, hw_lock
+  hw_lock = asyncio.Lock()
+  ftpserver = await asyncio.start_server(accept_ftp_connect, "0.0.0.0", port)
+  httpserver = None
+  if http:
+    httpserver = await asyncio.start_server(accept_http_connect, "0.0.0.0", http)
+  dataservers = []
+  for port in range(_DATA_PORT, _DATA_PORT + _DATA_PORTS):
+    data_ports[port] = [None, ticks_ms()]
+    dataservers.append(await asyncio.start_server(
+      lambda r, w, port=port: accept_data_connect(r, w, port),
+      "0.0.0.0", port))
+  try:
+    while run == 1:
+      await asyncio.sleep_ms(200)
+  finally: # also when task() is cancelled
+    ftpserver.close()
+    await ftpserver.wait_closed()
+    if httpserver:
+      httpserver.close()
+      await httpserver.wait_closed()
+    for stream in http_list:
+      await close_stream(stream)
+    for dataserver in dataservers:
+      dataserver.close()
+      await dataserver.wait_closed()
+    for client in client_list:
+      await client.close_dataclient()
+      await data_port_free(client)
+      await close_stream(client.command_client)
+    run = 0
+
+def server_thread(port, http):
+  global run
+  try:
+    asyncio.new_event_loop()
+    asyncio.run(serve(port, http))
+  except Exception as err:
+    print("FTP server stopped: {}".format(err))
+  run = 0
+
 def stop():
-  global ftpsocket, datasocket
-  global client_list
-  global client_busy
-
-  for client in client_list:
-    client.command_client.setsockopt(socket.SOL_SOCKET, _SO_REGISTER_HANDLER, None)
-    client.command_client.close()
-  del client_list
+  global run
+  global client_list, data_ports, http_list
+
+  if run:
+    run = 2
+    while run:
+      sleep_ms(50)
   client_list = []
-  client_busy = False
-  if ftpsocket is not None:
-    ftpsocket.setsockopt(socket.SOL_SOCKET, _SO_REGISTER_HANDLER, None)
-    ftpsocket.close()
-  if datasocket is not None:
-    datasocket.close()
+  data_ports = {}
+  http_list = []
 
 # start listening for ftp connections on port 21
-def start(port=21, verbose=0, splash=True):
-  global ftpsocket, datasocket
+# and for HTTP on port http, http=0: no HTTP server
+# in own thread with own asyncio loop
+def start(port=21, verbose=0, splash=True, http=0):
+  global run
+  if asyncio_running():
+    print("asyncio loop is running, use uftpd.task() in it")
+    return
+  setup(port, verbose, splash, http)
+  run = 1
+  start_thread(server_thread, (port, http))
+
+# serve as a task of the application's asyncio loop,
+# for applications using asyncio in the main thread.
+# returns the task, stop with task.cancel(), not stop()
+def task(port=21, verbose=0, splash=True, http=0):
+  global run
+  if run:
+    print("FTP server is running, call uftpd.stop() first")
+    return None
+  setup(port, verbose, splash, http)
+  run = 1
+  return asyncio.create_task(serve(port, http))
+
+def setup(port, verbose, splash, http):
   global verbose_l
-  global client_list
-  global client_busy
+  global client_list, data_ports, http_list
   global AP_addr, STA_addr
 
   alloc_emergency_exception_buf(100)
   verbose_l = verbose
   client_list = []
-  client_busy = False
-
-  ftpsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  datasocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-  ftpsocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-  datasocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-  ftpsocket.bind(('0.0.0.0', port))
-  datasocket.bind(('0.0.0.0', _DATA_PORT))
-
-  ftpsocket.listen(0)
-  datasocket.listen(0)
-
-  datasocket.settimeout(10)
-  ftpsocket.setsockopt(socket.SOL_SOCKET, _SO_REGISTER_HANDLER, accept_ftp_connect)
+  data_ports = {}
+  http_list = []
 
   wlan = network.WLAN(network.AP_IF)
   if wlan.active():
@@ -581,6 +1479,8 @@ def start(port=21, verbose=0, splash=True):
     AP_addr = (ifconfig[0], num_ip(ifconfig[0]), num_ip(ifconfig[1]))
     if splash:
       print("FTP server started on {}:{}".format(ifconfig[0], port))
+      if http:
+        print("HTTP server started on {}:{}".format(ifconfig[0], http))
   wlan = network.WLAN(network.STA_IF)
   if wlan.active():
     ifconfig = wlan.ifconfig()
@@ -588,11 +1488,13 @@ def start(port=21, verbose=0, splash=True):
     STA_addr = (ifconfig[0], num_ip(ifconfig[0]), num_ip(ifconfig[1]))
     if splash:
       print("FTP server started on {}:{}".format(ifconfig[0], port))
+      if http:
+        print("HTTP server started on {}:{}".format(ifconfig[0], http))
 
-def restart(port=21, verbose=0, splash=True):
+def restart(port=21, verbose=0, splash=True, http=0):
   stop()
   sleep_ms(200)
-  start(port, verbose, splash)
+  start(port, verbose, splash, http)
 
 start(splash=True)
 collect()
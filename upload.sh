@@ -7,7 +7,10 @@ $AMPY -p $PORT mkdir /lib
 $AMPY -p $PORT put ecp5.py /lib/ecp5.py
 $AMPY -p $PORT put uftpd.py /lib/uftpd.py
 $AMPY -p $PORT put sdraw.py /lib/sdraw.py
+$AMPY -p $PORT put webget.py /lib/webget.py
 $AMPY -p $PORT put ecp5wp.py /lib/ecp5wp.py
+$AMPY -p $PORT put flashidx.py /lib/flashidx.py
+$AMPY -p $PORT put hashsum.py /lib/hashsum.py
 $AMPY -p $PORT put ecp5setup.py /lib/ecp5setup.py
 $AMPY -p $PORT put dfu.py :/lib/dfu.py
 $AMPY -p $PORT put cp ptp.py :/lib/ptp.py
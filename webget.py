@@ -0,0 +1,365 @@
+# micropython ESP32
+# HTTP/1.1 GET with on-device cache of downloaded files
+
+# AUTHOR=EMARD
+# LICENSE=BSD
+
+# keep-alive connections are reused, chunked bodies
+# decoded, broken transfers resumed with Range requests.
+# cached files are validated with ETag / Last-Modified,
+# server reply "304 Not Modified" streams local copy
+# webget.cache_budget = 1<<20 # bytes, 0: no cache
+# webget.report()
+
+import os, io, socket
+from binascii import crc32
+
+cache_budget = 0 # bytes on VFS, 0: disabled
+cache_dir = "/webcache"
+
+count_hit = 0
+count_miss = 0
+count_saved = 0 # bytes not downloaded
+
+# key -> [url, etag, last_modified, size, lru]
+index = None
+
+def index_load():
+  global index
+  if index is None:
+    try:
+      import json
+      with open(cache_dir+"/index.json") as f:
+        index = json.load(f)
+    except:
+      index = {}
+
+def index_save():
+  import json
+  try:
+    os.mkdir(cache_dir)
+  except OSError:
+    pass
+  with open(cache_dir+"/index.json", "w") as f:
+    json.dump(index, f)
+
+def cache_used():
+  used = 0
+  for key in index:
+    used += index[key][3]
+  return used
+
+# remove least recently used files
+# until size more bytes fit into budget
+def evict(size):
+  used = cache_used()
+  while index and used+size > cache_budget:
+    key = min(index, key=lambda k: index[k][4])
+    used -= index[key][3]
+    del index[key]
+    try:
+      os.remove(cache_dir+"/"+key)
+    except OSError:
+      pass
+
+def split_url(url):
+  _, _, host, path = url.split('/', 3)
+  port = 80
+  if len(host.split(':')) == 2:
+    host, port = host.split(':', 2)
+    port = int(port)
+  return host, port, path
+
+# idle keep-alive connections (host, port) -> socket
+pool = {}
+timeout = 10 # s, socket timeout
+resume_retry = 3 # Range requests after broken transfer
+verbose = 1 # print progress
+
+def connect(host, port):
+  s = pool.pop((host, port), None)
+  if s:
+    return s, 1
+  addr = socket.getaddrinfo(host, port)[0][-1]
+  s = socket.socket()
+  s.settimeout(timeout)
+  s.connect(addr)
+  return s, 0
+
+def pool_close():
+  for key in pool:
+    pool[key].close()
+  pool.clear()
+
+# send GET with extra headers, parse status and headers
+# returns socket at start of body, status, headers (lowercase names)
+def send_get(host, port, path, headers=""):
+  for attempt in range(2):
+    s, reused = connect(host, port)
+    try:
+      s.send(bytes('GET /%s HTTP/1.1\r\nHost: %s\r\nAccept:  image/*\r\nConnection: keep-alive\r\n%s\r\n' % (path, host, headers), 'utf8'))
+      line = s.readline()
+      if not line:
+        raise OSError(104) # closed by server
+      break
+    except OSError:
+      s.close()
+      if not reused: # pooled connection may have timed out
+        raise
+  version, status = line.split()[0:2]
+  hdrs = {}
+  for i in range(100): # read first 100 lines searching for
+    line = s.readline()
+    if len(line) < 3: # first empty line (contains "\r\n")
+      break
+    name, _, value = line.decode().partition(":")
+    hdrs[name.strip().lower()] = value.strip()
+  if version == b"HTTP/1.0":
+    hdrs.setdefault("connection", "close")
+  return s, int(status), hdrs
+
+# HTTP body stream: Content-Length, chunked or until close
+# broken transfer of known length resumes with Range request
+class http_body(io.IOBase):
+  def __init__(self, host, port, path, headers=""):
+    self.host = host
+    self.port = port
+    self.path = path
+    self.pos = 0 # bytes of body read
+    self.s, self.status, self.hdrs = send_get(host, port, path, headers)
+    self.start()
+
+  def start(self):
+    hdrs = self.hdrs
+    self.length = int(hdrs.get("content-length", -1))
+    if self.status == 304 or self.status == 204:
+      self.length = 0
+    if self.status == 206: # total length is after "/"
+      self.length = int(hdrs.get("content-range", "/-1").split("/")[-1])
+    self.chunked = hdrs.get("transfer-encoding", "").lower() == "chunked"
+    if self.chunked:
+      self.length = -1
+    self.chunk = 0 # bytes remaining in current chunk
+    self.keep = hdrs.get("connection", "").lower() != "close"
+    self.done = self.length == 0
+    self.step = self.length//10 if self.length > 0 else 0 # progress print step
+
+  def read_chunk_size(self):
+    line = self.s.readline()
+    if line in (b"\r\n", b"\n"): # CRLF after previous chunk
+      line = self.s.readline()
+    self.chunk = int(line.split(b";")[0], 16)
+    if self.chunk == 0: # last chunk, skip trailer
+      while len(self.s.readline()) > 2:
+        pass
+      self.done = True
+
+  def readinto(self, buf):
+    for stalled in range(resume_retry+1): # resumes without new data
+      if self.done:
+        return 0
+      n = len(buf)
+      try:
+        if self.chunked:
+          if self.chunk == 0:
+            self.read_chunk_size()
+            if self.done:
+              return 0
+          n = min(n, self.chunk)
+        elif self.length > 0:
+          n = min(n, self.length-self.pos)
+        n = self.s.readinto(memoryview(buf)[:n])
+      except OSError:
+        n = 0
+      if n:
+        break
+      if self.length < 0 and not self.chunked: # body until close
+        self.done = True
+        self.keep = False
+        return 0
+      if stalled == resume_retry: # server closes without sending more
+        raise OSError(5)
+      self.resume()
+    self.pos += n
+    if self.chunked:
+      self.chunk -= n
+    elif self.pos == self.length:
+      self.done = True
+    if verbose and self.step and self.pos//self.step != (self.pos-n)//self.step:
+      print("%d%% of %d bytes" % (self.pos*100//self.length, self.length), end="\r")
+    return n
+
+  # reconnect and continue from self.pos
+  def resume(self):
+    self.s.close()
+    self.keep = False
+    if self.chunked or self.length < 0:
+      raise OSError(5) # can't resume, unknown length
+    for retry in range(resume_retry):
+      print("resume at %d of %d bytes" % (self.pos, self.length))
+      try:
+        cond = ""
+        etag = self.hdrs.get("etag")
+        if etag:
+          cond = "If-Range: %s\r\n" % etag
+        self.s, status, hdrs = send_get(self.host, self.port, self.path, "Range: bytes=%d-\r\n%s" % (self.pos, cond))
+        if status == 206 and hdrs.get("content-range", "").startswith("bytes %d-" % self.pos):
+          self.status = 206
+          self.hdrs["connection"] = hdrs.get("connection", "")
+          self.keep = self.hdrs["connection"].lower() != "close"
+          return
+        self.s.close()
+        break # content changed or Range not supported
+      except OSError:
+        pass
+    raise OSError(5) # truncated
+
+  def close(self):
+    if self.s:
+      if self.done and self.keep:
+        pool[(self.host, self.port)] = self.s
+      else:
+        self.s.close()
+      self.s = None
+
+# send GET with extra headers
+# returns body stream, status, headers (lowercase names)
+def request(url, headers=""):
+  host, port, path = split_url(url)
+  print("host = %s, port = %d, path = %s" % (host, port, path))
+  body = http_body(host, port, path, headers)
+  return body, body.status, body.hdrs
+
+# stream from socket which also writes
+# to cache file, entry is stored when
+# complete body is read
+class cache_writer(io.IOBase):
+  def __init__(self, s, key, entry):
+    self.s = s
+    self.key = key
+    self.entry = entry
+    self.n = 0
+    self.tmp = cache_dir+"/"+key+".tmp"
+    try:
+      self.f = open(self.tmp, "wb")
+    except OSError:
+      self.f = None
+
+  def readinto(self, buf):
+    n = self.s.readinto(buf)
+    if n:
+      self.n += n
+      if self.f:
+        try:
+          self.f.write(memoryview(buf)[:n])
+        except OSError: # VFS full
+          self.drop()
+    if not n or self.n == self.entry[3]: # end of body
+      self.finish()
+    return n
+
+  def drop(self):
+    if self.f:
+      self.f.close()
+      self.f = None
+      try:
+        os.remove(self.tmp)
+      except OSError:
+        pass
+
+  def finish(self):
+    if self.f is None:
+      return
+    if self.entry[3] >= 0 and self.n != self.entry[3]: # truncated
+      self.drop()
+      return
+    self.f.close()
+    self.f = None
+    self.entry[3] = self.n
+    self.entry[4] = max([e[4] for e in index.values()]+[0])+1
+    evict(self.n)
+    try:
+      os.remove(cache_dir+"/"+self.key)
+    except OSError:
+      pass
+    os.rename(self.tmp, cache_dir+"/"+self.key)
+    index[self.key] = self.entry
+    index_save()
+
+  def close(self):
+    self.drop() # not complete if still open
+    self.s.close()
+
+def cache_hit(key, entry):
+  global count_hit, count_saved
+  count_hit += 1
+  count_saved += entry[3]
+  entry[4] = max(e[4] for e in index.values())+1
+  index_save()
+  return open(cache_dir+"/"+key, "rb")
+
+# None for HTTP error status
+def check(body, url):
+  if body.status >= 300:
+    print("HTTP %d %s" % (body.status, url))
+    body.close()
+    return None
+  return body
+
+# returns stream of url body
+# from cache or from socket
+def get(url):
+  global count_miss
+  if not cache_budget:
+    return check(request(url)[0], url)
+  index_load()
+  key = "%08x" % crc32(url.encode())
+  entry = index.get(key)
+  if entry and entry[0] != url:
+    entry = None
+  cond = ""
+  if entry:
+    if entry[1]:
+      cond += "If-None-Match: %s\r\n" % entry[1]
+    if entry[2]:
+      cond += "If-Modified-Since: %s\r\n" % entry[2]
+  try:
+    s, status, hdrs = request(url, cond)
+  except OSError:
+    if entry: # server unreachable, use local copy
+      print("offline, using cached %s" % url)
+      return cache_hit(key, entry)
+    raise
+  if entry and status == 304:
+    s.close()
+    return cache_hit(key, entry)
+  count_miss += 1
+  if not check(s, url):
+    return None
+  length = s.length
+  etag = hdrs.get("etag", "")
+  modified = hdrs.get("last-modified", "")
+  if status != 200 or not (etag or modified) or length > cache_budget:
+    return s # can't be validated later or too large
+  if length > 0:
+    evict(length)
+  try:
+    os.mkdir(cache_dir)
+  except OSError:
+    pass
+  return cache_writer(s, key, [url, etag, modified, length, 0])
+
+def report():
+  index_load()
+  print("webcache: %d hits, %d misses, %d bytes saved, %d/%d bytes used" % (count_hit, count_miss, count_saved, cache_used(), cache_budget))
+
+def clear():
+  global index
+  index_load()
+  for key in index:
+    try:
+      os.remove(cache_dir+"/"+key)
+    except OSError:
+      pass
+  index = {}
+  index_save()